@@ -0,0 +1,163 @@
+"""Pub/sub transports that fan chat events out to every API worker."""
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Optional, Set
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+class Backplane:
+    """
+    Delivers published events to the handler of every subscribed worker,
+    including the publishing one.
+    """
+
+    async def start(self, handler: EventHandler):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict):
+        raise NotImplementedError
+
+    def fits(self, event: dict) -> bool:
+        """Whether publish can deliver the event to other workers, not just this one."""
+        return True
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryBackplane(Backplane):
+    """Single-process backplane; events loop straight back to the local handler."""
+
+    def __init__(self):
+        self._handler: Optional[EventHandler] = None
+
+    async def start(self, handler: EventHandler):
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+
+    async def publish(self, event: dict):
+        if self._handler:
+            await self._handler(event)
+
+
+class PostgresBackplane(Backplane):
+    """
+    Backplane over Postgres LISTEN/NOTIFY.
+
+    One dedicated connection listens on the channel and reconnects when it is
+    dropped; publishing goes through a small separate pool. NOTIFY payloads
+    are limited to 8000 bytes, so larger events are only delivered locally,
+    as are events whose NOTIFY fails; publish never raises for either.
+    Publishers check fits() first for events other workers must see.
+    """
+
+    MAX_PAYLOAD_BYTES = 7999
+    RECONNECT_DELAY_SECONDS = 1.0
+
+    def __init__(self, dsn: str, channel: str = "turf_chat"):
+        self.dsn = dsn
+        self.channel = channel
+        self._handler: Optional[EventHandler] = None
+        self._pool = None
+        self._listen_task: Optional[asyncio.Task] = None
+        self._dispatch_tasks: Set[asyncio.Task] = set()
+        self.oversized = 0
+        self.publish_failures = 0
+
+    async def start(self, handler: EventHandler):
+        import asyncpg
+
+        self._handler = handler
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+        self._listen_task = asyncio.create_task(self._listen_forever())
+
+    async def stop(self):
+        if self._listen_task:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except asyncio.CancelledError:
+                pass
+            self._listen_task = None
+        if self._pool:
+            await self._pool.close()
+            self._pool = None
+
+    @staticmethod
+    def _encode(event: dict) -> str:
+        return json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+    def fits(self, event: dict) -> bool:
+        return len(self._encode(event).encode("utf-8")) <= self.MAX_PAYLOAD_BYTES
+
+    async def publish(self, event: dict):
+        payload = self._encode(event)
+        if len(payload.encode("utf-8")) > self.MAX_PAYLOAD_BYTES:
+            self.oversized += 1
+            logger.warning("chat event too large for NOTIFY, delivering locally only")
+            await self._dispatch(payload)
+            return
+        try:
+            await self._pool.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+        except Exception as e:
+            self.publish_failures += 1
+            logger.warning("chat backplane publish failed, delivering locally only: %s", e)
+            await self._dispatch(payload)
+
+    async def _listen_forever(self):
+        import asyncpg
+
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda _conn: lost.done() or lost.set_result(None))
+                await conn.add_listener(self.channel, self._on_notify)
+                await lost
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("chat backplane listener failed: %s", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+
+    def _on_notify(self, _conn, _pid, _channel, payload: str):
+        task = asyncio.create_task(self._dispatch(payload))
+        self._dispatch_tasks.add(task)
+        task.add_done_callback(self._dispatch_tasks.discard)
+
+    async def _dispatch(self, payload: str):
+        try:
+            await self._handler(json.loads(payload))
+        except Exception as e:
+            logger.warning("chat backplane handler failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "oversized": self.oversized,
+            "publish_failures": self.publish_failures,
+            "dispatching": len(self._dispatch_tasks),
+        }
+
+
+def build_backplane(name: str) -> Backplane:
+    if name == "memory":
+        return MemoryBackplane()
+    if name == "postgres":
+        dsn = settings.database_url.replace("postgresql+asyncpg://", "postgresql://", 1)
+        return PostgresBackplane(dsn)
+    raise ValueError(f"unknown chat backplane: {name}")
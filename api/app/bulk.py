@@ -0,0 +1,425 @@
+"""
+Bulk claim import and region export.
+
+Imports stream records into a temporary staging table with COPY and then
+apply the 20 m spacing rule set-wise, so a batch costs a handful of
+statements instead of one check and commit per claim. Exports stream rows
+from a server-side cursor and never hold the whole region in memory.
+
+Run as a CLI from the api directory:
+
+    python -m app.bulk import claims.ndjson --owner <user id>
+    python -m app.bulk export --bbox -122.5,37.7,-122.3,37.8 > claims.ndjson
+"""
+import argparse
+import asyncio
+import codecs
+import json
+import sys
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import CLAIM_MIN_SPACING_M, claim_grid_cell_sql
+from .schemas import ClaimImportRow
+from .visibility import visibility_engine
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_GEOJSON = "geojson"
+FORMATS = (FORMAT_NDJSON, FORMAT_GEOJSON)
+
+# Why a record was not imported.
+REASON_INVALID = "invalid"
+REASON_UNKNOWN_OWNER = "unknown_owner"
+REASON_ALREADY_CLAIMED = "already_claimed"
+REASON_DUPLICATE_IN_BATCH = "duplicate_in_batch"
+REASON_CELL_TAKEN = "cell_taken"
+
+COPY_CHUNK_ROWS = 5000
+EXPORT_FETCH_ROWS = 1000
+
+_STAGING_COLUMNS = ("line", "id", "owner_id", "address_label", "lon", "lat", "builds")
+
+_CREATE_STAGING = """
+    CREATE TEMP TABLE claim_import (
+        line integer PRIMARY KEY,
+        id uuid NOT NULL,
+        owner_id uuid NOT NULL,
+        address_label text NOT NULL,
+        lon float8 NOT NULL,
+        lat float8 NOT NULL,
+        builds jsonb NOT NULL,
+        g geography,
+        cell text,
+        reason text,
+        conflict_claim uuid,
+        conflict_line integer,
+        inserted boolean NOT NULL DEFAULT false
+    ) ON COMMIT DROP
+"""
+
+_PREPARE_STAGING = [
+    f"""
+    UPDATE claim_import
+    SET g = ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography,
+        cell = {claim_grid_cell_sql("ST_SetSRID(ST_MakePoint(lon, lat), 4326)")}
+    """,
+    "CREATE INDEX ON claim_import USING gist (g)",
+    "ANALYZE claim_import",
+]
+
+# Conflicts with the ROW EXCLUSIVE lock every INSERT into claims takes, and with itself.
+_LOCK_CLAIMS = "LOCK TABLE claims IN SHARE ROW EXCLUSIVE MODE"
+
+# Each step only looks at rows no earlier step rejected. Within a batch a row
+# loses to any earlier surviving row closer than the spacing; this is
+# slightly stricter than one-by-one inserts when conflicts chain.
+_CLASSIFY = [
+    f"""
+    UPDATE claim_import s SET reason = '{REASON_UNKNOWN_OWNER}'
+    WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.owner_id)
+    """,
+    f"""
+    WITH hit AS (
+        SELECT s.line,
+               (SELECT c.id FROM claims c WHERE ST_DWithin(c.location, s.g, :spacing) LIMIT 1) AS claim_id
+        FROM claim_import s
+        WHERE s.reason IS NULL
+    )
+    UPDATE claim_import s SET reason = '{REASON_ALREADY_CLAIMED}', conflict_claim = hit.claim_id
+    FROM hit
+    WHERE hit.line = s.line AND hit.claim_id IS NOT NULL
+    """,
+    f"""
+    WITH hit AS (
+        SELECT s.line,
+               (SELECT min(o.line) FROM claim_import o
+                WHERE o.reason IS NULL AND o.line < s.line AND ST_DWithin(o.g, s.g, :spacing)) AS other
+        FROM claim_import s
+        WHERE s.reason IS NULL
+    )
+    UPDATE claim_import s SET reason = '{REASON_DUPLICATE_IN_BATCH}', conflict_line = hit.other
+    FROM hit
+    WHERE hit.line = s.line AND hit.other IS NOT NULL
+    """,
+]
+
+# The grid cell conflict catches claims committed by others since the checks.
+_INSERT_CLAIMS = """
+    WITH ins AS (
+        INSERT INTO claims (id, owner_id, address_label, location, grid_cell, created_at)
+        SELECT id, owner_id, address_label, g, cell, :now
+        FROM claim_import
+        WHERE reason IS NULL
+        ORDER BY line
+        ON CONFLICT (grid_cell) DO NOTHING
+        RETURNING id
+    )
+    UPDATE claim_import s SET inserted = true FROM ins WHERE ins.id = s.id
+"""
+
+_MARK_CELL_TAKEN = f"""
+    UPDATE claim_import SET reason = '{REASON_CELL_TAKEN}' WHERE reason IS NULL AND NOT inserted
+"""
+
+# Builds keep their file order through created_at, like builds added one by one.
+_INSERT_BUILDS = """
+    INSERT INTO builds (id, claim_id, prefab, decal, flag, height_m, created_at)
+    SELECT gen_random_uuid(), s.id, b.value->>'prefab', b.value->>'decal', b.value->>'flag',
+           (b.value->>'height_m')::int, CAST(:now AS timestamp) + b.ord * interval '1 microsecond'
+    FROM claim_import s
+    CROSS JOIN LATERAL jsonb_array_elements(s.builds) WITH ORDINALITY AS b(value, ord)
+    WHERE s.inserted
+"""
+
+_REPORT = """
+    SELECT line, reason, conflict_claim, conflict_line
+    FROM claim_import
+    WHERE reason IS NOT NULL
+    ORDER BY line
+"""
+
+_IMPORTED_OWNERS = "SELECT DISTINCT owner_id FROM claim_import WHERE inserted"
+
+_EXPORT = """
+    SELECT c.id, c.owner_id, c.address_label, c.created_at,
+           c.lon, c.lat,
+           (SELECT COALESCE(json_agg(json_build_object(
+                       'prefab', b.prefab, 'decal', b.decal, 'flag', b.flag, 'height_m', b.height_m)
+                       ORDER BY b.created_at), '[]')
+            FROM builds b WHERE b.claim_id = c.id) AS builds
+    FROM claims c
+    WHERE c.location::geometry && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+    ORDER BY c.id
+"""
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a stream of UTF-8 byte chunks into lines without buffering the stream."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def iter_records(lines: AsyncIterator[str], fmt: str) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Yield (line, record) pairs from NDJSON or GeoJSON input.
+
+    NDJSON has one claim or GeoJSON Feature per line and is streamed; line is
+    the 1-based line number. A GeoJSON FeatureCollection is a single document
+    and is parsed whole; line is then the 1-based feature index. Records that
+    are not valid JSON are yielded as the ValueError raised while parsing.
+    """
+    if fmt == FORMAT_NDJSON:
+        number = 0
+        async for line in lines:
+            number += 1
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, e
+        return
+    document = "\n".join([line async for line in lines])
+    try:
+        collection = json.loads(document)
+    except ValueError as e:
+        yield 1, e
+        return
+    if not isinstance(collection, dict) or collection.get("type") != "FeatureCollection":
+        yield 1, ValueError("expected a GeoJSON FeatureCollection")
+        return
+    for number, feature in enumerate(collection.get("features") or [], start=1):
+        yield number, feature
+
+
+def parse_record(record: Any) -> ClaimImportRow:
+    """Validate a plain claim object or a GeoJSON Point Feature."""
+    if isinstance(record, Exception):
+        raise ValueError(str(record))
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    if record.get("type") == "Feature":
+        geometry = record.get("geometry") or {}
+        coordinates = geometry.get("coordinates") or []
+        if geometry.get("type") != "Point" or len(coordinates) < 2:
+            raise ValueError("feature geometry must be a Point")
+        record = {**(record.get("properties") or {}), "lon": coordinates[0], "lat": coordinates[1]}
+    return ClaimImportRow(**record)
+
+
+def _validation_message(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in error.errors())
+    return str(error)
+
+
+async def import_claims(
+    session: AsyncSession,
+    records: AsyncIterator[Tuple[int, Any]],
+    owner_id: Optional[uuid.UUID] = None,
+    force_owner: bool = False,
+) -> Tuple[dict, List[uuid.UUID]]:
+    """
+    Import claims in one transaction, refresh the visibility of owners that
+    gained claims in it, and commit.
+
+    Rows use their own owner_id, falling back to owner_id; with force_owner
+    every row belongs to owner_id. Returns the report (counts plus one
+    conflict entry per rejected line) and the owners that gained claims.
+    """
+    conflicts: List[dict] = []
+    received = 0
+    staged = 0
+    await session.execute(text(_CREATE_STAGING))
+    raw = await (await session.connection()).get_raw_connection()
+    driver = raw.driver_connection
+
+    chunk: List[tuple] = []
+    async for line, record in records:
+        received += 1
+        try:
+            row = parse_record(record)
+        except ValueError as e:
+            conflicts.append({"line": line, "reason": REASON_INVALID, "detail": _validation_message(e)})
+            continue
+        row_owner = owner_id if force_owner else (row.owner_id or owner_id)
+        if row_owner is None:
+            conflicts.append({"line": line, "reason": REASON_INVALID, "detail": "owner_id: field required"})
+            continue
+        builds = json.dumps([build.dict() for build in row.builds])
+        chunk.append((line, uuid.uuid4(), row_owner, row.address_label, row.lon, row.lat, builds))
+        if len(chunk) >= COPY_CHUNK_ROWS:
+            await driver.copy_records_to_table("claim_import", records=chunk, columns=_STAGING_COLUMNS)
+            staged += len(chunk)
+            chunk = []
+    if chunk:
+        await driver.copy_records_to_table("claim_import", records=chunk, columns=_STAGING_COLUMNS)
+        staged += len(chunk)
+
+    owners: List[uuid.UUID] = []
+    if staged:
+        params = {"spacing": CLAIM_MIN_SPACING_M}
+        for statement in _PREPARE_STAGING:
+            await session.execute(text(statement))
+        # Too many rows for per-claim spacing locks; hold off single claims
+        # (and other imports) instead until this import commits.
+        await session.execute(text(_LOCK_CLAIMS))
+        for statement in _CLASSIFY:
+            await session.execute(text(statement), params)
+        now = datetime.utcnow()
+        await session.execute(text(_INSERT_CLAIMS), {"now": now})
+        await session.execute(text(_MARK_CELL_TAKEN))
+        await session.execute(text(_INSERT_BUILDS), {"now": now})
+        result = await session.execute(text(_REPORT))
+        for line, reason, conflict_claim, conflict_line in result.all():
+            entry: Dict[str, Any] = {"line": line, "reason": reason}
+            if conflict_claim is not None:
+                entry["conflict_claim_id"] = str(conflict_claim)
+            if conflict_line is not None:
+                entry["conflict_line"] = conflict_line
+            conflicts.append(entry)
+        result = await session.execute(text(_IMPORTED_OWNERS))
+        owners = [row[0] for row in result.all()]
+        for owner in owners:
+            await visibility_engine.on_claims_changed(session, owner)
+    await session.commit()
+
+    conflicts.sort(key=lambda entry: entry["line"])
+    report = {
+        "received": received,
+        "inserted": received - len(conflicts),
+        "rejected": len(conflicts),
+        "conflicts": conflicts,
+    }
+    return report, owners
+
+
+def _feature(row) -> dict:
+    builds = row.builds
+    if isinstance(builds, str):
+        builds = json.loads(builds)
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [row.lon, row.lat]},
+        "properties": {
+            "id": str(row.id),
+            "owner_id": str(row.owner_id),
+            "address_label": row.address_label,
+            "created_at": row.created_at.isoformat(),
+            "builds": builds,
+        },
+    }
+
+
+async def export_claims(
+    session: AsyncSession, bbox: Tuple[float, float, float, float], fmt: str = FORMAT_NDJSON
+) -> AsyncIterator[str]:
+    """
+    Stream the claims inside bbox (min_lon, min_lat, max_lon, max_lat) as text.
+
+    NDJSON yields one GeoJSON Feature per line; GeoJSON yields a
+    FeatureCollection in pieces. Both can be fed back into import_claims.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    result = await session.stream(
+        text(_EXPORT).execution_options(yield_per=EXPORT_FETCH_ROWS),
+        {"min_lon": min_lon, "min_lat": min_lat, "max_lon": max_lon, "max_lat": max_lat},
+    )
+    first = True
+    if fmt == FORMAT_GEOJSON:
+        yield '{"type":"FeatureCollection","features":['
+    async for row in result:
+        feature = json.dumps(_feature(row), separators=(",", ":"))
+        if fmt == FORMAT_GEOJSON:
+            yield feature if first else "," + feature
+        else:
+            yield feature + "\n"
+        first = False
+    if fmt == FORMAT_GEOJSON:
+        yield "]}\n"
+
+
+def parse_bbox(value: str) -> Tuple[float, float, float, float]:
+    """Parse "min_lon,min_lat,max_lon,max_lat"."""
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    return parts[0], parts[1], parts[2], parts[3]
+
+
+async def _file_lines(path: str) -> AsyncIterator[str]:
+    handle = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in handle:
+            yield line.rstrip("\n")
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+async def _run_import(args) -> dict:
+    from .cache import map_cache
+    from .database import AsyncSessionLocal
+
+    owner = uuid.UUID(args.owner) if args.owner else None
+    async with AsyncSessionLocal() as session:
+        report, owners = await import_claims(
+            session, iter_records(_file_lines(args.path), args.format), owner, force_owner=args.force_owner
+        )
+        await map_cache.invalidate_all()
+    return report
+
+
+async def _run_export(args):
+    from .database import AsyncReadSessionLocal
+
+    async with AsyncReadSessionLocal() as session:
+        async for piece in export_claims(session, parse_bbox(args.bbox), args.format):
+            sys.stdout.write(piece)
+
+
+def _format_from(path: str) -> str:
+    return FORMAT_GEOJSON if path.endswith((".geojson", ".json")) else FORMAT_NDJSON
+
+
+def main(argv: Optional[Iterable[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m app.bulk", description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="import claims from a file ('-' for stdin)")
+    importer.add_argument("path")
+    importer.add_argument("--format", choices=FORMATS, help="defaults from the file extension")
+    importer.add_argument("--owner", help="owner id for rows without owner_id")
+    importer.add_argument("--force-owner", action="store_true", help="ignore owner_id in rows")
+
+    exporter = commands.add_parser("export", help="export claims in a bounding box to stdout")
+    exporter.add_argument("--bbox", required=True, help="min_lon,min_lat,max_lon,max_lat")
+    exporter.add_argument("--format", choices=FORMATS, default=FORMAT_NDJSON)
+
+    args = parser.parse_args(argv)
+    if args.command == "import":
+        if args.force_owner and not args.owner:
+            parser.error("--force-owner needs --owner")
+        args.format = args.format or _format_from(args.path)
+        report = asyncio.run(_run_import(args))
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        asyncio.run(_run_export(args))
+
+
+if __name__ == "__main__":
+    main()
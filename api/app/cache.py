@@ -0,0 +1,233 @@
+"""In-process result caches for the map endpoints."""
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from .config import settings
+from .geo import METERS_PER_DEGREE, meters_to_lon_degrees
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire after a TTL."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class CacheBackend:
+    """Storage interface for MapCache. Subclass to plug in a shared store."""
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl_seconds: float):
+        raise NotImplementedError
+
+    async def delete(self, keys: Iterable[str]):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process LRU/TTL storage."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._cache = TTLCache(max_entries, ttl_seconds)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: Any, ttl_seconds: float):
+        self._cache.set(key, value, ttl_seconds)
+
+    async def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self._cache.pop(key)
+
+    async def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+
+class NullBackend(CacheBackend):
+    """Backend that never stores anything, used to disable caching."""
+
+    async def get(self, key: str) -> Optional[Any]:
+        return None
+
+    async def set(self, key: str, value: Any, ttl_seconds: float):
+        pass
+
+    async def delete(self, keys: Iterable[str]):
+        pass
+
+    async def clear(self):
+        pass
+
+
+def build_backend(name: str) -> CacheBackend:
+    if name == "memory":
+        return MemoryBackend(settings.map_cache_max_entries, settings.map_cache_ttl_seconds)
+    if name == "none":
+        return NullBackend()
+    raise ValueError(f"unknown cache backend: {name}")
+
+
+# Requested radii are rounded up to one of these before caching.
+RADIUS_BUCKETS_M = (250, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+# A cell's fetch radius is its bucket plus this fraction of the bucket. It
+# covers the cell's half diagonal (at most ~0.71 of the bucket) plus slack for
+# the spheroid/sphere distance mismatch.
+FETCH_MARGIN = 0.75
+
+
+class NearbyCell:
+    """Cache key and fetch disk for a /nearby query snapped to a grid cell."""
+
+    def __init__(self, lat: float, lon: float, radius_m: int):
+        self.bucket_m = next((b for b in RADIUS_BUCKETS_M if b >= radius_m), radius_m)
+        cell_deg = self.bucket_m / METERS_PER_DEGREE
+        row = math.floor(lat / cell_deg)
+        col = math.floor(lon / cell_deg)
+        self.key = f"nearby:{self.bucket_m}:{row}:{col}"
+        self.lat = (row + 0.5) * cell_deg
+        self.lon = (col + 0.5) * cell_deg
+        self.fetch_radius_m = self.bucket_m * (1 + FETCH_MARGIN)
+
+
+def _nearby_keys_covering(lat: float, lon: float) -> List[str]:
+    """All /nearby cell keys whose fetch disk may contain the point."""
+    keys = []
+    for bucket in RADIUS_BUCKETS_M:
+        cell_deg = bucket / METERS_PER_DEGREE
+        reach_m = bucket * (1 + FETCH_MARGIN)
+        lat_reach = reach_m / METERS_PER_DEGREE
+        lon_reach = meters_to_lon_degrees(reach_m, abs(lat) + lat_reach)
+        for row in range(math.floor((lat - lat_reach) / cell_deg), math.floor((lat + lat_reach) / cell_deg) + 1):
+            for col in range(math.floor((lon - lon_reach) / cell_deg), math.floor((lon + lon_reach) / cell_deg) + 1):
+                keys.append(f"nearby:{bucket}:{row}:{col}")
+    return keys
+
+
+class MapCache:
+    """
+    Result cache for /nearby and /my-claims.
+
+    /nearby entries are keyed on a grid cell sized to the radius bucket and
+    hold every claim within the cell's fetch disk, so any query point inside
+    the cell can be answered by filtering the entry. /my-claims entries are
+    keyed per owner.
+
+    Writes call invalidate_claim() with the claim position and owner, which
+    drops exactly the cells whose fetch disk can contain that position. With
+    the memory backend invalidation is local to the process; other workers
+    converge within the TTL.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl_seconds: float):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any):
+        await self.backend.set(key, value, self.ttl_seconds)
+
+    @staticmethod
+    def nearby_cell(lat: float, lon: float, radius_m: int) -> NearbyCell:
+        return NearbyCell(lat, lon, radius_m)
+
+    @staticmethod
+    def my_claims_key(owner_id) -> str:
+        return f"my:{owner_id}"
+
+    async def invalidate_claim(self, lat: float, lon: float, owner_id):
+        keys = _nearby_keys_covering(lat, lon)
+        keys.append(self.my_claims_key(owner_id))
+        self.invalidations += 1
+        await self.backend.delete(keys)
+
+    async def invalidate_all(self):
+        """Drop every entry, for writes too large to invalidate claim by claim."""
+        self.invalidations += 1
+        await self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "backend": self.backend.stats(),
+        }
+
+
+map_cache = MapCache(build_backend(settings.map_cache_backend), settings.map_cache_ttl_seconds)
@@ -0,0 +1,285 @@
+"""In-memory ring buffers of the newest messages in active chat rooms."""
+import bisect
+import hashlib
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select, tuple_
+
+from .config import settings
+from .database import AsyncSessionLocal
+from .message_writer import MessageWriter, message_writer
+from .models import Message, User
+
+# Rough per-message overhead of the dict and its id/timestamp strings
+_ENTRY_OVERHEAD_BYTES = 400
+
+
+def room_uuid(room_id) -> uuid.UUID:
+    """The UUID a chat room id is stored under; non-UUID ids map to their MD5."""
+    try:
+        return uuid.UUID(str(room_id))
+    except ValueError:
+        return uuid.UUID(hashlib.md5(str(room_id).encode()).hexdigest())
+
+
+def _entry_size(entry: dict) -> int:
+    return _ENTRY_OVERHEAD_BYTES + len(entry["body"]) + len(entry["attachment_url"] or "") + len(entry["sender_handle"] or "")
+
+
+def _row_entry(message: Message, sender_handle: Optional[str]) -> dict:
+    return {
+        "id": str(message.id),
+        "sender_id": str(message.sender_id),
+        "sender_handle": sender_handle,
+        "room_id": str(message.room_id),
+        "body": message.body,
+        "attachment_url": message.attachment_url,
+        "attachment_type": message.attachment_type,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def _unwritten_entry(row: dict, sender_handle: Optional[str]) -> dict:
+    return {
+        "id": str(row["id"]),
+        "sender_id": str(row["sender_id"]),
+        "sender_handle": sender_handle,
+        "room_id": str(row["room_id"]),
+        "body": row["body"],
+        "attachment_url": row["attachment_url"],
+        "attachment_type": row["attachment_type"],
+        "created_at": row["created_at"].isoformat(),
+    }
+
+
+class _Room:
+    __slots__ = ("entries", "keys", "ids", "size", "seeded", "whole")
+
+    def __init__(self):
+        self.entries: List[dict] = []
+        self.keys: List[tuple] = []
+        self.ids: Set[str] = set()
+        self.size = 0
+        # seeded: holds every message since the newest ones loaded from the table
+        # whole: the room had fewer messages than the buffer holds when loaded
+        self.seeded = False
+        self.whole = False
+
+
+class RecentMessages:
+    """
+    Keeps the newest room_size messages of each active room, in the shape of
+    MessageOut and already joined with sender handles.
+
+    A room's buffer is loaded from the primary once, on first read, and kept
+    current from then on by every broadcast this worker delivers, which with
+    the Postgres backplane includes broadcasts from other workers. Buffers are
+    evicted least recently used first once their total estimated size passes
+    max_bytes.
+
+    With CHAT_DURABILITY=async a WebSocket message is broadcast before it is
+    written, so a load also takes this worker's rows the writer has not
+    committed yet; messages other workers have not written are still only
+    seen if they are broadcast after the buffer is created. Handles are
+    copied when a message arrives and do not follow later handle changes.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        room_size: int = 100,
+        max_bytes: int = 32 * 1024 * 1024,
+        writer: Optional[MessageWriter] = None,
+    ):
+        self.session_factory = session_factory
+        self.writer = writer
+        self.room_size = room_size
+        self.max_bytes = max_bytes
+        self.rooms: "OrderedDict[str, _Room]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.room_size > 0
+
+    def _add(self, room: _Room, entry: dict):
+        if entry["id"] in room.ids:
+            return
+        key = (entry["created_at"], entry["id"])
+        index = bisect.bisect(room.keys, key)
+        if index == 0 and len(room.entries) >= self.room_size:
+            return
+        room.keys.insert(index, key)
+        room.entries.insert(index, entry)
+        room.ids.add(entry["id"])
+        size = _entry_size(entry)
+        room.size += size
+        self.size += size
+        while len(room.entries) > self.room_size:
+            room.whole = False
+            room.keys.pop(0)
+            oldest = room.entries.pop(0)
+            room.ids.discard(oldest["id"])
+            size = _entry_size(oldest)
+            room.size -= size
+            self.size -= size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.rooms) > 1:
+            _, room = self.rooms.popitem(last=False)
+            self.size -= room.size
+            self.evictions += 1
+
+    def append(self, message: dict):
+        """Add a broadcast message frame to its room's buffer, if that room is buffered."""
+        if not self.enabled or not message.get("id"):
+            return
+        key = str(room_uuid(message["room_id"]))
+        room = self.rooms.get(key)
+        if room is None:
+            return
+        self._add(room, {
+            "id": message["id"],
+            "sender_id": message["sender_id"],
+            "sender_handle": message.get("sender_handle"),
+            "room_id": key,
+            "body": message["body"],
+            "attachment_url": message.get("attachment_url"),
+            "attachment_type": message.get("attachment_type"),
+            "created_at": message["created_at"],
+        })
+        self._evict()
+
+    async def ensure(self, room_id):
+        """Load a room's newest messages unless its buffer is already loaded."""
+        if not self.enabled:
+            return
+        key = str(room_uuid(room_id))
+        room = self.rooms.get(key)
+        if room is not None and room.seeded:
+            return
+        if room is None:
+            # Created before the query so broadcasts during it are kept
+            room = self.rooms[key] = _Room()
+        # Rows not committed before the query starts: queued, mid-flush or submitted during it
+        unwritten = self.writer.watch(key) if self.writer else []
+        try:
+            async with self.session_factory() as session:
+                result = await session.execute(
+                    select(Message, User.handle)
+                    .join(User, Message.sender_id == User.id)
+                    .where(Message.room_id == key)
+                    .order_by(Message.created_at.desc(), Message.id.desc())
+                    .limit(self.room_size)
+                )
+                rows = result.all()
+                handles = {}
+                senders = {uuid.UUID(str(row["sender_id"])) for row in unwritten}
+                if senders:
+                    result = await session.execute(select(User.id, User.handle).where(User.id.in_(senders)))
+                    handles = {str(user_id): handle for user_id, handle in result.all()}
+        finally:
+            if self.writer:
+                self.writer.unwatch(key, unwritten)
+        self.loads += 1
+        if self.rooms.get(key) is not room:
+            return
+        for message, sender_handle in rows:
+            self._add(room, _row_entry(message, sender_handle))
+        for row in unwritten:
+            self._add(room, _unwritten_entry(row, handles.get(str(row["sender_id"]))))
+        room.seeded = True
+        room.whole = len(rows) < self.room_size
+        self._evict()
+
+    def recent(self, room_id, limit: int) -> Optional[List[dict]]:
+        """The newest limit messages of a room, oldest first, or None if the buffer cannot answer."""
+        key = str(room_uuid(room_id))
+        room = self.rooms.get(key)
+        if room is None or not room.seeded or limit > self.room_size or (len(room.entries) < limit and not room.whole):
+            self.misses += 1
+            return None
+        self.rooms.move_to_end(key)
+        self.hits += 1
+        return room.entries[-limit:] if limit > 0 else []
+
+    def find(self, room_id, message_id: str) -> Optional[dict]:
+        """A buffered message of a room by id."""
+        room = self.rooms.get(str(room_uuid(room_id)))
+        if room is None or message_id not in room.ids:
+            return None
+        return next(entry for entry in room.entries if entry["id"] == message_id)
+
+    def after(self, room_id, created_at: str, message_id: str) -> Optional[List[dict]]:
+        """
+        Messages of a room newer than (created_at, message_id), oldest first,
+        or None unless the buffer is known to hold all of them.
+        """
+        key = str(room_uuid(room_id))
+        room = self.rooms.get(key)
+        since = (created_at, message_id)
+        if room is None or not room.seeded or not (room.whole or (room.keys and room.keys[0] <= since)):
+            self.misses += 1
+            return None
+        self.rooms.move_to_end(key)
+        self.hits += 1
+        return room.entries[bisect.bisect(room.keys, since):]
+
+    async def since(self, room_id, created_at: str, message_id: str, limit: int) -> Optional[List[dict]]:
+        """
+        Messages of a room newer than (created_at, message_id), oldest first.
+
+        Answered from the buffer when it reaches back far enough, otherwise
+        from the table merged with anything buffered but not yet written.
+        None if more than limit messages are missing that way.
+        """
+        buffered = self.after(room_id, created_at, message_id)
+        if buffered is not None:
+            return buffered
+        key = str(room_uuid(room_id))
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Message, User.handle)
+                .join(User, Message.sender_id == User.id)
+                .where(
+                    Message.room_id == key,
+                    tuple_(Message.created_at, Message.id) > tuple_(datetime.fromisoformat(created_at), uuid.UUID(message_id)),
+                )
+                .order_by(Message.created_at.asc(), Message.id.asc())
+                .limit(limit + 1)
+            )
+            rows = result.all()
+        if len(rows) > limit:
+            return None
+        entries = {entry["id"]: entry for entry in (_row_entry(message, handle) for message, handle in rows)}
+        room = self.rooms.get(key)
+        if room is not None:
+            start = bisect.bisect(room.keys, (created_at, message_id))
+            entries.update((entry["id"], entry) for entry in room.entries[start:])
+        return sorted(entries.values(), key=lambda entry: (entry["created_at"], entry["id"]))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rooms": len(self.rooms),
+            "messages": sum(len(room.entries) for room in self.rooms.values()),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+recent_messages = RecentMessages(
+    room_size=settings.chat_history_room_size,
+    max_bytes=settings.chat_history_max_bytes,
+    writer=message_writer,
+)
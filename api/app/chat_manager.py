@@ -1,38 +1,281 @@
-from typing import Dict, Set, List, Tuple
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
 from fastapi import WebSocket
 
+from .backplane import Backplane, build_backplane
+from .chat_history import RecentMessages, recent_messages
+from .config import settings
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+
+# Close code sent to consumers that cannot keep up ("try again later").
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Rooms per presence event, busiest first; enough for get_top_rooms
+PRESENCE_MAX_ROOMS = 100
+
+
+class ChatConnection:
+    """Outbound side of one socket: a bounded queue of frames drained by a writer task."""
+
+    def __init__(self, websocket: WebSocket, max_queue: int):
+        self.websocket = websocket
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+        # While held, broadcasts collect here as (message id, frame) instead of the queue
+        self.held: Optional[List[Tuple[Optional[str], str]]] = None
+        # Set once more broadcasts arrived while held than the queue holds
+        self.held_overflow = False
+        # Sent before anything in the queue
+        self.backlog: Deque[str] = deque()
+
+    def start(self, on_error):
+        self.task = asyncio.create_task(self._write_loop(on_error))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _write_loop(self, on_error):
+        try:
+            while self.backlog:
+                await self.websocket.send_text(self.backlog.popleft())
+            while True:
+                text = await self.queue.get()
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            on_error(self)
+
+
 class ChatManager:
-    def __init__(self):
-        self.rooms: Dict[str, Set[WebSocket]] = {}
+    """
+    Tracks the chat sockets of this worker and fans broadcasts out through a
+    backplane, so every worker delivers to its own sockets.
+
+    Each worker periodically publishes the socket counts of its busiest
+    rooms, which lets get_top_rooms report cluster-wide online counts.
+
+    Messages are serialised once per broadcast and queued per socket, so a slow
+    client never stalls the room or the sender. When a socket's queue is full
+    the overflow policy either drops its oldest queued frame or disconnects it.
+
+    Every delivered message also goes into the history buffers, which a
+    joining socket can be handed before it goes live.
+    """
+
+    def __init__(
+        self,
+        backplane: Backplane,
+        presence_interval: float = 10.0,
+        max_queue: int = 100,
+        overflow_policy: str = OVERFLOW_DROP_OLDEST,
+        history: Optional[RecentMessages] = None,
+    ):
+        if overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT):
+            raise ValueError(f"unknown overflow policy: {overflow_policy}")
+        self.rooms: Dict[str, Dict[WebSocket, ChatConnection]] = {}
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.dropped_messages = 0
+        self.slow_disconnects = 0
+        self.backplane = backplane
+        self.history = history
+        self.node_id = uuid.uuid4().hex
+        self.presence_interval = presence_interval
+        # node_id -> (last seen monotonic time, {room_id: count})
+        self.remote_rooms: Dict[str, Tuple[float, Dict[str, int]]] = {}
+        self._started = False
+        self._presence_task: Optional[asyncio.Task] = None
+        self._close_tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        await self.backplane.start(self._on_event)
+        self._started = True
+        self._presence_task = asyncio.create_task(self._presence_loop())
+
+    async def stop(self):
+        if self._presence_task:
+            self._presence_task.cancel()
+            self._presence_task = None
+        self._started = False
+        await self.backplane.stop()
 
-    async def connect(self, room_id: str, websocket: WebSocket):
+    async def connect(self, room_id: str, websocket: WebSocket, hold: bool = False):
+        """
+        Accept and register a socket. With hold=True nothing is sent until
+        release(); broadcasts meanwhile are kept aside, so a backlog can be
+        looked up without losing or repeating anything sent in the meantime.
+        At most max_queue broadcasts are kept; past that the overflow policy
+        applies, and with drop_oldest the socket gets a resync frame instead.
+        """
         await websocket.accept()
-        self.rooms.setdefault(room_id, set()).add(websocket)
+        conn = ChatConnection(websocket, self.max_queue)
+        self.rooms.setdefault(room_id, {})[websocket] = conn
+        if hold:
+            conn.held = []
+            return
+        conn.start(lambda c: self.disconnect(room_id, c.websocket))
+
+    def release(self, room_id: str, websocket: WebSocket, backlog: List[dict]):
+        """
+        Start a held socket: backlog frames first, then broadcasts held since
+        connect, skipping repeats by id. If the held broadcasts overflowed,
+        only a resync frame is sent.
+        """
+        conn = self.rooms.get(room_id, {}).get(websocket)
+        if conn is None or conn.held is None:
+            return
+        if conn.held_overflow:
+            backlog = [{"type": "resync"}]
+        seen = {frame.get("id") for frame in backlog}
+        conn.backlog.extend(json.dumps(frame, separators=(",", ":"), ensure_ascii=False) for frame in backlog)
+        conn.backlog.extend(text for message_id, text in conn.held if message_id is None or message_id not in seen)
+        conn.held = None
+        conn.held_overflow = False
+        conn.start(lambda c: self.disconnect(room_id, c.websocket))
 
     def disconnect(self, room_id: str, websocket: WebSocket):
         if room_id in self.rooms and websocket in self.rooms[room_id]:
-            self.rooms[room_id].remove(websocket)
+            self.rooms[room_id].pop(websocket).stop()
             if not self.rooms[room_id]:
                 self.rooms.pop(room_id, None)
 
+    def fits(self, room_id: str, message: dict) -> bool:
+        """Whether a broadcast of message reaches every worker; callers reject it otherwise."""
+        return self.backplane.fits({"type": "broadcast", "room_id": room_id, "message": message})
+
     async def broadcast(self, room_id: str, message: dict):
+        if not self._started:
+            await self._on_event({"type": "broadcast", "room_id": room_id, "message": message})
+            return
+        await self.backplane.publish({"type": "broadcast", "room_id": room_id, "message": message})
+
+    def send_personal(self, room_id: str, websocket: WebSocket, message: dict):
+        """Queue a frame for one socket, behind anything already queued for it."""
+        conn = self.rooms.get(room_id, {}).get(websocket)
+        if conn is None:
+            return
+        try:
+            conn.queue.put_nowait(json.dumps(message, separators=(",", ":"), ensure_ascii=False))
+        except asyncio.QueueFull:
+            conn.dropped += 1
+            self.dropped_messages += 1
+
+    async def _deliver(self, room_id: str, message: dict):
         if room_id not in self.rooms:
             return
-        dead = []
-        for ws in self.rooms[room_id]:
+        # Same encoding as WebSocket.send_json, done once for the whole room
+        text = json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+        slow = []
+        for conn in list(self.rooms[room_id].values()):
+            if conn.held is not None:
+                if len(conn.held) < self.max_queue and not conn.held_overflow:
+                    conn.held.append((message.get("id"), text))
+                    continue
+                if self.overflow_policy == OVERFLOW_DISCONNECT:
+                    slow.append(conn)
+                    continue
+                # The gap is unrecoverable from here; the client resyncs on release
+                conn.dropped += len(conn.held) + 1
+                self.dropped_messages += len(conn.held) + 1
+                conn.held.clear()
+                conn.held_overflow = True
+                continue
+            try:
+                conn.queue.put_nowait(text)
+                continue
+            except asyncio.QueueFull:
+                pass
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                slow.append(conn)
+                continue
+            conn.queue.get_nowait()
+            conn.queue.put_nowait(text)
+            conn.dropped += 1
+            self.dropped_messages += 1
+        for conn in slow:
+            self.slow_disconnects += 1
+            self.disconnect(room_id, conn.websocket)
+            task = asyncio.create_task(self._close_quietly(conn.websocket))
+            self._close_tasks.add(task)
+            task.add_done_callback(self._close_tasks.discard)
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket):
+        try:
+            await websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+    async def _on_event(self, event: dict):
+        kind = event.get("type")
+        if kind == "broadcast":
+            if self.history is not None and event["message"].get("type") == "message":
+                self.history.append(event["message"])
+            await self._deliver(event["room_id"], event["message"])
+        elif kind == "presence" and event.get("node") != self.node_id:
+            self.remote_rooms[event["node"]] = (time.monotonic(), event.get("rooms", {}))
+
+    async def _presence_loop(self):
+        while True:
+            counts = sorted(
+                ((room_id, len(connections)) for room_id, connections in self.rooms.items()),
+                key=lambda item: item[1],
+                reverse=True,
+            )[:PRESENCE_MAX_ROOMS]
+            event = {"type": "presence", "node": self.node_id, "rooms": dict(counts)}
+            # Long room ids can still overflow the backplane; keep the busiest half until it fits
+            while len(counts) > 1 and not self.backplane.fits(event):
+                counts = counts[:len(counts) // 2]
+                event["rooms"] = dict(counts)
             try:
-                await ws.send_json(message)
+                await self.backplane.publish(event)
             except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(room_id, ws)
+                pass
+            await asyncio.sleep(self.presence_interval)
 
     def get_top_rooms(self, limit: int = 10) -> List[Tuple[str, int]]:
         """
-        Get top rooms by online user count.
+        Get top rooms by online user count across all workers.
         Returns list of (room_id, user_count) tuples sorted by user count descending.
+        Other workers only report their PRESENCE_MAX_ROOMS busiest rooms.
         """
-        room_counts = [(room_id, len(connections)) for room_id, connections in self.rooms.items()]
+        totals: Dict[str, int] = {room_id: len(connections) for room_id, connections in self.rooms.items()}
+        expiry = time.monotonic() - 3 * self.presence_interval
+        for node, (seen, rooms) in list(self.remote_rooms.items()):
+            if seen < expiry:
+                self.remote_rooms.pop(node, None)
+                continue
+            for room_id, count in rooms.items():
+                totals[room_id] = totals.get(room_id, 0) + count
+        room_counts = list(totals.items())
         return sorted(room_counts, key=lambda x: x[1], reverse=True)[:limit]
 
-manager = ChatManager()
+    def stats(self) -> dict:
+        depths = [conn.queue.qsize() for room in self.rooms.values() for conn in room.values()]
+        return {
+            "rooms": len(self.rooms),
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnects": self.slow_disconnects,
+            "backplane": self.backplane.stats(),
+        }
+
+manager = ChatManager(
+    build_backplane(settings.chat_backplane),
+    presence_interval=settings.chat_presence_interval_seconds,
+    max_queue=settings.chat_send_queue_size,
+    overflow_policy=settings.chat_overflow_policy,
+    history=recent_messages,
+)
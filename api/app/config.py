@@ -8,6 +8,16 @@ class Settings(BaseSettings):
         "postgresql+asyncpg://turf:turf@db:5432/turf",
         env="DATABASE_URL",
     )
+    # Optional read replica for read-heavy endpoints
+    database_read_url: Optional[str] = Field(None, env="DATABASE_READ_URL")
+    db_pool_size: int = Field(5, env="DB_POOL_SIZE")
+    db_max_overflow: int = Field(10, env="DB_MAX_OVERFLOW")
+    db_pool_timeout: int = Field(30, env="DB_POOL_TIMEOUT")
+    db_pool_recycle: int = Field(1800, env="DB_POOL_RECYCLE")
+    db_pool_pre_ping: bool = Field(True, env="DB_POOL_PRE_PING")
+    # Set both to 0 behind pgbouncer in transaction mode
+    db_statement_cache_size: int = Field(100, env="DB_STATEMENT_CACHE_SIZE")
+    db_prepared_statement_cache_size: int = Field(100, env="DB_PREPARED_STATEMENT_CACHE_SIZE")
     allowed_origin: str = Field("*", env="ALLOWED_ORIGIN")
     jwt_secret: str = Field("changeme-secret", env="JWT_SECRET")
     
@@ -15,8 +25,62 @@ class Settings(BaseSettings):
     google_client_id: Optional[str] = Field(None, env="GOOGLE_CLIENT_ID")
     google_client_secret: Optional[str] = Field(None, env="GOOGLE_CLIENT_SECRET")
     google_redirect_uri: Optional[str] = Field(None, env="GOOGLE_REDIRECT_URI")
+    google_jwks_url: str = Field("https://www.googleapis.com/oauth2/v3/certs", env="GOOGLE_JWKS_URL")
+    google_jwks_refresh_seconds: int = Field(3600, env="GOOGLE_JWKS_REFRESH_SECONDS")
     frontend_url: str = Field("http://localhost:3000", env="FRONTEND_URL")
 
+    # Verified-token and current-user caches used by get_current_user
+    auth_cache_max_entries: int = Field(10000, env="AUTH_CACHE_MAX_ENTRIES")
+    auth_cache_ttl_seconds: int = Field(60, env="AUTH_CACHE_TTL_SECONDS")
+
+    # Per-user friend sets used for friendship checks; a TTL of 0 disables the cache
+    friend_cache_max_entries: int = Field(10000, env="FRIEND_CACHE_MAX_ENTRIES")
+    friend_cache_ttl_seconds: int = Field(60, env="FRIEND_CACHE_TTL_SECONDS")
+
+    # Per-room member sets used to authorise chat reads and writes
+    room_member_cache_max_entries: int = Field(10000, env="ROOM_MEMBER_CACHE_MAX_ENTRIES")
+    room_member_cache_ttl_seconds: int = Field(300, env="ROOM_MEMBER_CACHE_TTL_SECONDS")
+
+    # Room opens are coalesced per (user, room) and upserted in batches
+    room_access_flush_seconds: float = Field(5.0, env="ROOM_ACCESS_FLUSH_SECONDS")
+    room_access_max_pending: int = Field(5000, env="ROOM_ACCESS_MAX_PENDING")
+
+    # bcrypt worker threads, and how many more requests may wait before failing fast
+    password_workers: int = Field(4, env="PASSWORD_WORKERS")
+    password_queue_depth: int = Field(32, env="PASSWORD_QUEUE_DEPTH")
+
+    # Vector tiles
+    tile_cache_seconds: int = Field(60, env="TILE_CACHE_SECONDS")
+
+    # /nearby and /my-claims result cache ("memory" or "none")
+    map_cache_backend: str = Field("memory", env="MAP_CACHE_BACKEND")
+    map_cache_max_entries: int = Field(10000, env="MAP_CACHE_MAX_ENTRIES")
+    map_cache_ttl_seconds: int = Field(300, env="MAP_CACHE_TTL_SECONDS")
+
+    # Fog-of-war visibility radii
+    visibility_home_radius_m: int = Field(1609, env="VISIBILITY_HOME_RADIUS_M")
+    visibility_path_radius_m: int = Field(200, env="VISIBILITY_PATH_RADIUS_M")
+    # Supply paths die this long after their last touch; a sweep expires them
+    supply_path_lifetime_days: int = Field(30, env="SUPPLY_PATH_LIFETIME_DAYS")
+    supply_path_sweep_seconds: int = Field(300, env="SUPPLY_PATH_SWEEP_SECONDS")
+    supply_path_sweep_batch_size: int = Field(1000, env="SUPPLY_PATH_SWEEP_BATCH_SIZE")
+
+    # Chat fan-out across workers ("memory" for a single worker, or "postgres")
+    chat_backplane: str = Field("memory", env="CHAT_BACKPLANE")
+    chat_presence_interval_seconds: int = Field(10, env="CHAT_PRESENCE_INTERVAL_SECONDS")
+    # Per-socket outbound queue; "drop_oldest" or "disconnect" when it overflows
+    chat_send_queue_size: int = Field(100, env="CHAT_SEND_QUEUE_SIZE")
+    chat_overflow_policy: str = Field("drop_oldest", env="CHAT_OVERFLOW_POLICY")
+    # WebSocket message persistence: batched INSERTs, acked on enqueue ("async") or commit ("sync")
+    chat_write_batch_size: int = Field(200, env="CHAT_WRITE_BATCH_SIZE")
+    chat_write_flush_ms: int = Field(50, env="CHAT_WRITE_FLUSH_MS")
+    chat_durability: str = Field("async", env="CHAT_DURABILITY")
+    # Newest messages kept in memory per active room for /messages and socket joins
+    chat_history_room_size: int = Field(100, env="CHAT_HISTORY_ROOM_SIZE")
+    chat_history_max_bytes: int = Field(32 * 1024 * 1024, env="CHAT_HISTORY_MAX_BYTES")
+    # Most missed messages a reconnecting socket is sent before being told to resync
+    chat_resume_max_messages: int = Field(500, env="CHAT_RESUME_MAX_MESSAGES")
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,14 +1,82 @@
+import time
+
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 
-from .database import get_session
+from .cache import TTLCache
+from .config import settings
+from .database import engine, get_read_session, get_session, read_engine
 from .models import User
 from .security import decode_token
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login", auto_error=False)
 
+# Verified token -> claims, and user id -> UserSnapshot. Both are per process.
+token_cache = TTLCache(settings.auth_cache_max_entries, settings.auth_cache_ttl_seconds)
+user_cache = TTLCache(settings.auth_cache_max_entries, settings.auth_cache_ttl_seconds)
+
+
+class UserSnapshot:
+    """
+    Detached copy of the User columns handlers read.
+
+    get_current_user returns this instead of a session-bound User so cached
+    lookups need no database access. Handlers that modify the user must load
+    it with db.get(User, current.id) and call invalidate_user afterwards.
+    """
+
+    __slots__ = ("id", "handle", "email", "bio", "avatar_url", "verified", "created_at")
+
+    def __init__(self, user: User):
+        self.id = user.id
+        self.handle = user.handle
+        self.email = user.email
+        self.bio = user.bio
+        self.avatar_url = user.avatar_url
+        self.verified = user.verified
+        self.created_at = user.created_at
+
+
+def invalidate_user(user_id):
+    """Drop a cached user snapshot after the user row changes."""
+    user_cache.pop(str(user_id))
+
+
+def _decode_cached(token: str) -> Optional[dict]:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    payload = decode_token(token)
+    if not payload or "sub" not in payload:
+        return None
+    # Never keep a token cached past its own expiry
+    ttl = settings.auth_cache_ttl_seconds
+    if "exp" in payload:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        token_cache.set(token, payload, ttl)
+    return payload
+
+
+async def load_user(db: AsyncSession, user_id: str) -> Optional[UserSnapshot]:
+    """Cached snapshot of a user, or None if the user does not exist."""
+    snapshot = user_cache.get(str(user_id))
+    if snapshot is not None:
+        return snapshot
+    user = await db.get(User, user_id)
+    if not user:
+        return None
+    snapshot = UserSnapshot(user)
+    user_cache.set(str(user_id), snapshot)
+    return snapshot
+
+
+def auth_cache_stats() -> dict:
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
+
+
 async def get_token_from_request(request: Request, token: Optional[str] = Depends(oauth2_scheme)) -> Optional[str]:
     """Get token from Authorization header or cookies."""
     # First try the Authorization header
@@ -19,29 +87,41 @@ async def get_token_from_request(request: Request, token: Optional[str] = Depend
     return cookie_token
 
 async def get_db() -> AsyncSession:
+    """
+    Request-scoped session. FastAPI resolves a dependency once per request,
+    so handlers and get_current_user share this session and its connection.
+    """
     async for session in get_session():
         yield session
 
-async def get_current_user(token: Optional[str] = Depends(get_token_from_request), db: AsyncSession = Depends(get_db)) -> User:
+async def get_read_db(db: AsyncSession = Depends(get_db)) -> AsyncSession:
+    """Session for read-only handlers: a replica session if one is configured, else the request's own."""
+    if read_engine is engine:
+        yield db
+        return
+    async for session in get_read_session():
+        yield session
+
+async def get_current_user(token: Optional[str] = Depends(get_token_from_request), db: AsyncSession = Depends(get_db)) -> UserSnapshot:
     """Get current authenticated user. Raises exception if not authenticated."""
     if not token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
     
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
+    payload = _decode_cached(token)
+    if not payload:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
-    user = await db.get(User, payload["sub"])
+    user = await load_user(db, payload["sub"])
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="user not found")
     return user
 
-async def get_current_user_optional(token: Optional[str] = Depends(get_token_from_request), db: AsyncSession = Depends(get_db)) -> Optional[User]:
+async def get_current_user_optional(token: Optional[str] = Depends(get_token_from_request), db: AsyncSession = Depends(get_db)) -> Optional[UserSnapshot]:
     """Get current user if authenticated, otherwise return None."""
     if not token:
         return None
     
-    payload = decode_token(token)
-    if not payload or "sub" not in payload:
+    payload = _decode_cached(token)
+    if not payload:
         return None
-    user = await db.get(User, payload["sub"])
+    user = await load_user(db, payload["sub"])
     return user
@@ -0,0 +1,138 @@
+"""Friendship lookups over accepted connections."""
+import uuid
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import and_, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from .cache import TTLCache
+from .config import settings
+from .models import Connection, FriendEdge
+
+# Accepted connections are indexed under their (least, greatest) user pair.
+_FRIENDS_AMONG = text(
+    """
+    SELECT o.id
+    FROM unnest(CAST(:others AS uuid[])) AS o(id)
+    WHERE EXISTS (
+        SELECT 1 FROM connections c
+        WHERE c.status = 'accepted'
+          AND LEAST(c.requester_id, c.addressee_id) = LEAST(CAST(:user_id AS uuid), o.id)
+          AND GREATEST(c.requester_id, c.addressee_id) = GREATEST(CAST(:user_id AS uuid), o.id)
+    )
+    """
+)
+
+_FRIEND_IDS = text("SELECT friend_id FROM friend_edges WHERE user_id = CAST(:user_id AS uuid)")
+
+
+def _canonical(value) -> Optional[str]:
+    """Canonical UUID string for an id, or None if it is not a UUID."""
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+class FriendshipService:
+    """
+    Answers "which of these users are friends with this user" in one query.
+
+    With a cache, each user's full friend set is loaded once and reused until
+    request_connection or approve_connection invalidates it or the TTL runs
+    out. The cache is per process, so other workers may answer from a stale
+    set for up to the TTL.
+    """
+
+    def __init__(self, cache: Optional[TTLCache] = None):
+        self.cache = cache
+
+    async def friend_ids(self, db: AsyncSession, user_id) -> Set[str]:
+        """All users with an accepted connection to user_id."""
+        key = str(user_id)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        result = await db.execute(_FRIEND_IDS, {"user_id": key})
+        friends = {str(row[0]) for row in result.all()}
+        if self.cache is not None:
+            self.cache.set(key, frozenset(friends))
+        return friends
+
+    async def friends_among(self, db: AsyncSession, user_id, others: Iterable) -> Set[str]:
+        """The subset of others (as UUID strings) that are friends with user_id."""
+        candidates = {_canonical(other) for other in others} - {None}
+        if not candidates:
+            return set()
+        if self.cache is not None:
+            return set(await self.friend_ids(db, user_id)) & candidates
+        result = await db.execute(_FRIENDS_AMONG, {"user_id": str(user_id), "others": list(candidates)})
+        return {str(row[0]) for row in result.all()}
+
+    async def not_friends(self, db: AsyncSession, user_id, others: Iterable) -> List:
+        """The items of others that are not friends with user_id, in their given order."""
+        others = list(others)
+        friends = await self.friends_among(db, user_id, others)
+        return [other for other in others if _canonical(other) not in friends]
+
+    async def mutual_counts(self, db: AsyncSession, user_id, others: Iterable) -> Dict[str, int]:
+        """Number of friends user_id shares with each of others (missing means none)."""
+        candidates = list({_canonical(other) for other in others} - {None})
+        if not candidates:
+            return {}
+        mine = aliased(FriendEdge)
+        theirs = aliased(FriendEdge)
+        result = await db.execute(
+            select(theirs.user_id, func.count())
+            .join(mine, and_(mine.user_id == user_id, mine.friend_id == theirs.friend_id))
+            .where(theirs.user_id.in_(candidates))
+            .group_by(theirs.user_id)
+        )
+        return {str(other): count for other, count in result.all()}
+
+    async def link(self, db: AsyncSession, connection: Connection):
+        """
+        Add the adjacency rows of a newly accepted connection and mark it
+        linked. The caller commits and then calls invalidate for both users;
+        invalidating any earlier would let a concurrent read cache the old
+        friend sets.
+        """
+        connection.edges_linked = True
+        edges = [
+            (connection.requester_id, connection.addressee_id),
+            (connection.addressee_id, connection.requester_id),
+        ]
+        await db.execute(
+            pg_insert(FriendEdge)
+            .values([
+                {
+                    "user_id": user_id,
+                    "friend_id": friend_id,
+                    "connection_id": connection.id,
+                    "created_at": connection.created_at,
+                }
+                for user_id, friend_id in edges
+            ])
+            .on_conflict_do_nothing()
+        )
+
+    async def are_friends(self, db: AsyncSession, user_id, other_id) -> bool:
+        return bool(await self.friends_among(db, user_id, [other_id]))
+
+    def invalidate(self, *user_ids):
+        if self.cache is not None:
+            for user_id in user_ids:
+                self.cache.pop(str(user_id))
+
+    def stats(self) -> dict:
+        return self.cache.stats() if self.cache is not None else {}
+
+
+friendships = FriendshipService(
+    TTLCache(settings.friend_cache_max_entries, settings.friend_cache_ttl_seconds)
+    if settings.friend_cache_ttl_seconds > 0
+    else None
+)
@@ -0,0 +1,33 @@
+"""Small spherical geometry helpers shared by the map endpoints."""
+import math
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two lat/lon points in meters."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def meters_to_lon_degrees(meters: float, lat: float) -> float:
+    """Convert a distance in meters to degrees of longitude at a latitude."""
+    scale = max(math.cos(math.radians(min(abs(lat), 89.0))), 1e-6)
+    return meters / (METERS_PER_DEGREE * scale)
+
+
+def pixel_size_degrees(zoom: float, tile_size: int = 256) -> float:
+    """Width of one screen pixel in degrees of longitude at a web map zoom level."""
+    return 360.0 / (tile_size * 2 ** zoom)
+
+
+def decimal_digits_for(tolerance_deg: float) -> int:
+    """Number of coordinate decimals needed to keep error below a tolerance."""
+    if tolerance_deg <= 0:
+        return 9
+    return max(0, min(9, math.ceil(-math.log10(tolerance_deg))))
@@ -1,21 +1,46 @@
 import asyncio
-from typing import List, Optional
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+from uuid import UUID, uuid4
 
-from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import select
+from sqlalchemy import select, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import func
 
+from . import bulk
+from .cache import map_cache
+from .chat_history import recent_messages
+from .chat_manager import manager as chat_manager
 from .config import settings
-from .database import Base, engine, get_session
-from .models import Build, Claim, User
-from .schemas import BuildCreate, BuildOut, ClaimCreate, ClaimOut, NearbyQuery, UserCreate, UserOut
+from .database import AsyncReadSessionLocal, Base, engine, is_replica, pool_stats
+from .friends import friendships
+from .geo import haversine_m
+from .message_writer import message_writer
+from .models import CLAIM_MIN_SPACING_M, SCHEMA_PATCHES, Build, Claim, User, claim_grid_cell_sql, claim_lock_sql
+from .path_decay import path_decay
+from .schemas import BuildCreate, BuildOut, BulkImportReport, ClaimCreate, ClaimOut, NearbyQuery, UserCreate, UserOut
+from .room_access import room_access
+from .rooms import room_members
 from .routes import router as api_router
-from .deps import get_current_user_optional, get_current_user
+from .deps import auth_cache_stats, get_current_user_optional, get_current_user, get_db, get_read_db
+from .security import PasswordWorkOverloaded, google_verifier, password_pool_stats
+from .tiles import is_valid_tile, render_tile
+from .visibility import visibility_engine
+
+logger = logging.getLogger(__name__)
+
+NEARBY_LIMIT = 200
+# Max claims held by one cached /nearby cell; denser cells bypass the cache.
+NEARBY_CELL_LIMIT = 2000
+# Cached in place of a cell's claims once the cell is known to be too dense
+NEARBY_DENSE_CELL = "dense"
 
 app = FastAPI(
     title=settings.app_name,
@@ -78,10 +103,41 @@ async def startup_event():
     # Ensure tables exist in local/dev. In prod use migrations.
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    for statement in SCHEMA_PATCHES:
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(statement))
+        except Exception as e:
+            logger.warning("schema patch failed: %s (%s)", statement, e)
+    await chat_manager.start()
+    await message_writer.start()
+    await google_verifier.start()
+    await path_decay.start()
+    await room_access.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers, flushing buffered writes."""
+    await chat_manager.stop()
+    await message_writer.stop()
+    await google_verifier.stop()
+    await path_decay.stop()
+    await room_access.stop()
 
 app.include_router(api_router)
 
 
+@app.exception_handler(PasswordWorkOverloaded)
+async def password_overloaded_handler(request: Request, exc: PasswordWorkOverloaded):
+    """Fail fast with 503 when the bcrypt pool is saturated."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "too many sign-in attempts, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.get("/openapi.json", tags=["Documentation"], include_in_schema=False)
 async def get_openapi():
     """Get the OpenAPI schema."""
@@ -104,6 +160,24 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/stats", tags=["Health"])
+async def stats():
+    """Report in-process cache, connection pool and background worker counters for sizing."""
+    return {
+        "map_cache": map_cache.stats(),
+        "chat": chat_manager.stats(),
+        "message_writer": message_writer.stats(),
+        "auth_cache": auth_cache_stats(),
+        "password_pool": password_pool_stats(),
+        "db_pool": pool_stats(),
+        "path_decay": path_decay.stats(),
+        "friend_cache": friendships.stats(),
+        "room_members": room_members.stats(),
+        "room_access": room_access.stats(),
+        "chat_history": recent_messages.stats(),
+    }
+
+
 @app.get("/docs", tags=["Documentation"])
 async def docs_redirect(current_user: Optional[User] = Depends(get_current_user_optional)):
     """
@@ -262,7 +336,7 @@ async def home(
 
 
 @app.post("/users", response_model=UserOut)
-async def create_user(payload: UserCreate, session: AsyncSession = Depends(get_session)):
+async def create_user(payload: UserCreate, session: AsyncSession = Depends(get_db)):
     user = User(handle=payload.handle)
     session.add(user)
     try:
@@ -270,39 +344,54 @@ async def create_user(payload: UserCreate, session: AsyncSession = Depends(get_s
     except IntegrityError:
         await session.rollback()
         raise HTTPException(status_code=400, detail="handle already taken")
-    await session.refresh(user)
     return user
 
 
 @app.post("/claims", response_model=ClaimOut)
 async def create_claim(
     payload: ClaimCreate,
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """Create a claim at a specific location.
     
     Uses the authenticated user as the owner.
-    Enforces single claim per ~20m grid.
+    Enforces at most one claim within 20m.
     Users can have multiple claims.
     """
-    from geoalchemy2.functions import ST_Point
-    
-    # enforce single claim per coordinate (approx 20m grid by rounding 5th decimal ~1.1m)
+    # The spacing locks serialize concurrent claims that could be in range of
+    # each other; the spacing check then uses the GiST index on location, and
+    # the unique grid cell still backs it up at (almost) the same point.
     pt_wkt = f"SRID=4326;POINT({payload.lon} {payload.lat})"
-    existing = await session.execute(
-        select(Claim).where(func.ST_DWithin(Claim.location, func.ST_GeogFromText(pt_wkt), 20))
-    )
-    if existing.scalars().first():
-        raise HTTPException(status_code=409, detail="location already claimed")
-
-    claim = Claim(
-        owner_id=current_user.id,
-        address_label=payload.address_label,
-        location=func.ST_GeogFromText(pt_wkt),
-    )
-    session.add(claim)
     try:
+        await session.execute(text(claim_lock_sql("ST_GeogFromText(:wkt)")), {"wkt": pt_wkt})
+        result = await session.execute(
+            text(
+                f"""
+                WITH pt AS (SELECT ST_GeogFromText(:wkt) AS g)
+                INSERT INTO claims (id, owner_id, address_label, location, grid_cell, created_at)
+                SELECT :id, :owner_id, :address_label, pt.g, {claim_grid_cell_sql("pt.g")}, :created_at
+                FROM pt
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM claims c WHERE ST_DWithin(c.location, pt.g, :spacing)
+                )
+                ON CONFLICT (grid_cell) DO NOTHING
+                RETURNING id
+                """
+            ),
+            {
+                "wkt": pt_wkt,
+                "id": uuid4(),
+                "owner_id": current_user.id,
+                "address_label": payload.address_label,
+                "created_at": datetime.utcnow(),
+                "spacing": CLAIM_MIN_SPACING_M,
+            },
+        )
+        claim_id = result.scalar()
+        if claim_id is not None:
+            # Same transaction, so the request needs a single connection
+            await visibility_engine.on_claims_changed(session, current_user.id)
         await session.commit()
     except IntegrityError as e:
         await session.rollback()
@@ -310,34 +399,103 @@ async def create_claim(
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=400, detail=f"failed to create claim: {str(e)}")
-    await session.refresh(claim)
+    if claim_id is None:
+        raise HTTPException(status_code=409, detail="location already claimed")
     lon, lat = payload.lon, payload.lat
+    await map_cache.invalidate_claim(lat, lon, current_user.id)
     return ClaimOut(
-        id=str(claim.id),
-        owner_id=str(claim.owner_id),
-        address_label=claim.address_label,
+        id=str(claim_id),
+        owner_id=str(current_user.id),
+        address_label=payload.address_label,
         lat=lat,
         lon=lon,
     )
 
 
-@app.get("/nearby", response_model=List[dict])
-async def nearby(q: NearbyQuery = Depends(), session: AsyncSession = Depends(get_session)):
-    """Get all claims within a radius, including their builds."""
-    pt_wkt = f"SRID=4326;POINT({q.lon} {q.lat})"
+@app.post("/claims/import", response_model=BulkImportReport)
+async def import_claims(
+    request: Request,
+    format: str = Query(bulk.FORMAT_NDJSON, pattern="^(ndjson|geojson)$"),
+    session: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Import many claims owned by the current user in one transaction.
+
+    - **format**: `ndjson` (one claim or GeoJSON Point Feature per line, streamed)
+      or `geojson` (a FeatureCollection)
+
+    A claim is `{ lat, lon, address_label, builds? }`, where builds are
+    `{ prefab, decal, flag, height_m }`; Features carry the same fields as
+    properties. Claims closer than 20m to an existing claim or to an earlier
+    line of the same import are rejected. Every rejected line is listed in
+    `conflicts` with its reason.
+    """
+    records = bulk.iter_records(bulk.iter_lines(request.stream()), format)
+    report, owners = await bulk.import_claims(session, records, current_user.id, force_owner=True)
+    if report["inserted"]:
+        await map_cache.invalidate_all()
+    return report
+
+
+@app.get("/claims/export")
+async def export_claims(
+    min_lon: float = Query(..., ge=-180, le=180),
+    min_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    format: str = Query(bulk.FORMAT_NDJSON, pattern="^(ndjson|geojson)$"),
+    current_user: User = Depends(get_current_user),
+):
+    """Stream every claim in a bounding box, with its builds, as GeoJSON Features.
+
+    - **format**: `ndjson` (one Feature per line) or `geojson` (a FeatureCollection)
+
+    The output can be imported again with `POST /claims/import`.
+    """
+    if min_lon > max_lon or min_lat > max_lat:
+        raise HTTPException(status_code=422, detail="bbox min must not exceed max")
+
+    async def body():
+        # The response outlives request dependencies, so the stream owns its session
+        async with AsyncReadSessionLocal() as session:
+            async for piece in bulk.export_claims(session, (min_lon, min_lat, max_lon, max_lat), format):
+                yield piece
+
+    media_type = "application/geo+json" if format == bulk.FORMAT_GEOJSON else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+
+async def _builds_by_claim(session: AsyncSession, claim_ids: list) -> Dict[UUID, List[Build]]:
+    """Load builds for many claims in one query, grouped by claim id.
+
+    Builds keep their creation order so ``builds[0]`` is the claim's first build.
+    """
+    if not claim_ids:
+        return {}
     result = await session.execute(
-        select(Claim, func.ST_X(func.ST_AsText(Claim.location)), func.ST_Y(func.ST_AsText(Claim.location)))
-        .where(func.ST_DWithin(Claim.location, func.ST_GeogFromText(pt_wkt), q.radius_m))
-        .limit(200)
+        select(Build)
+        .where(Build.claim_id.in_(claim_ids))
+        .order_by(Build.claim_id, Build.created_at)
+    )
+    grouped: Dict[UUID, List[Build]] = {}
+    for build in result.scalars().all():
+        grouped.setdefault(build.claim_id, []).append(build)
+    return grouped
+
+
+async def _fetch_nearby(session: AsyncSession, lat: float, lon: float, radius_m: float, limit: int) -> List[dict]:
+    """Query claims within radius_m of a point, with their first build's appearance."""
+    pt_wkt = f"SRID=4326;POINT({lon} {lat})"
+    result = await session.execute(
+        select(Claim.id, Claim.owner_id, Claim.address_label, Claim.lat, Claim.lon)
+        .where(func.ST_DWithin(Claim.location, func.ST_GeogFromText(pt_wkt), radius_m))
+        .limit(limit)
     )
     rows = result.all()
+    builds_by_claim = await _builds_by_claim(session, [claim.id for claim in rows])
     claims = []
-    for claim, lon, lat in rows:
-        # Fetch builds for this claim
-        builds_result = await session.execute(
-            select(Build).where(Build.claim_id == claim.id)
-        )
-        builds = builds_result.scalars().all()
+    for claim in rows:
+        builds = builds_by_claim.get(claim.id, [])
         
         # Use first build's prefab/flag/height, or defaults
         prefab = 'cyber'
@@ -353,8 +511,8 @@ async def nearby(q: NearbyQuery = Depends(), session: AsyncSession = Depends(get
             "id": str(claim.id),
             "owner_id": str(claim.owner_id),
             "address_label": claim.address_label,
-            "lat": float(lat),
-            "lon": float(lon),
+            "lat": claim.lat,
+            "lon": claim.lon,
             "prefab": prefab,
             "flag": flag,
             "height_m": height_m,
@@ -362,10 +520,71 @@ async def nearby(q: NearbyQuery = Depends(), session: AsyncSession = Depends(get
     return claims
 
 
+@app.get("/nearby", response_model=List[dict])
+async def nearby(q: NearbyQuery = Depends(), session: AsyncSession = Depends(get_read_db)):
+    """Get all claims within a radius, including their builds.
+
+    Results are served from a cache keyed on a grid cell and radius bucket.
+    Each cell entry covers every claim that any query point in the cell can
+    reach, and is filtered down to the exact radius here. Only primary reads
+    fill the cache: a lagging replica would otherwise refill an entry that a
+    claim write just invalidated with rows from before that write.
+
+    Cells too dense to hold are cached as a marker instead, so later queries
+    in them go straight to the direct query.
+    """
+    cell = map_cache.nearby_cell(q.lat, q.lon, q.radius_m)
+    candidates = await map_cache.get(cell.key)
+    if candidates == NEARBY_DENSE_CELL:
+        return await _fetch_nearby(session, q.lat, q.lon, q.radius_m, NEARBY_LIMIT)
+    if candidates is None:
+        candidates = await _fetch_nearby(session, cell.lat, cell.lon, cell.fetch_radius_m, NEARBY_CELL_LIMIT)
+        if len(candidates) >= NEARBY_CELL_LIMIT:
+            # Holds no rows, so a replica read may set it too
+            await map_cache.set(cell.key, NEARBY_DENSE_CELL)
+            return await _fetch_nearby(session, q.lat, q.lon, q.radius_m, NEARBY_LIMIT)
+        if not is_replica(session):
+            await map_cache.set(cell.key, candidates)
+    claims = [c for c in candidates if haversine_m(q.lat, q.lon, c["lat"], c["lon"]) <= q.radius_m]
+    return claims[:NEARBY_LIMIT]
+
+
+@app.get("/tiles/{z}/{x}/{y}.mvt", tags=["Map"])
+async def claim_tile(
+    z: int,
+    x: int,
+    y: int,
+    request: Request,
+    session: AsyncSession = Depends(get_db),
+):
+    """
+    Get claims and their builds as a Mapbox Vector Tile.
+
+    The tile has a single `claims` layer. Low zoom levels return clustered
+    points with a `count`; high zoom levels return one point per claim with
+    its prefab, flag and height_m.
+
+    Responses carry an ETag and Cache-Control so clients and CDNs can reuse
+    tiles across pans.
+    """
+    if not is_valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail="tile out of range")
+
+    tile = await render_tile(session, z, x, y)
+    etag = f'"{hashlib.md5(tile).hexdigest()}"'
+    headers = {
+        "Cache-Control": f"public, max-age={settings.tile_cache_seconds}",
+        "ETag": etag,
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
+
+
 @app.delete("/claims/{claim_id}")
 async def delete_claim(
     claim_id: str,
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """Delete a claim owned by the current user."""
@@ -384,7 +603,10 @@ async def delete_claim(
     
     # Delete the claim (cascades to builds)
     await session.delete(claim)
+    await session.flush()
+    await visibility_engine.on_claims_changed(session, claim.owner_id)
     await session.commit()
+    await map_cache.invalidate_claim(claim.lat, claim.lon, claim.owner_id)
     
     return {"status": "deleted"}
 
@@ -393,7 +615,7 @@ async def delete_claim(
 async def update_claim(
     claim_id: str,
     payload: dict,
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """Update a claim's address label."""
@@ -414,44 +636,44 @@ async def update_claim(
         claim.address_label = payload["address_label"]
     
     await session.commit()
-    await session.refresh(claim)
-    
-    # Get coordinates
-    result = await session.execute(
-        select(func.ST_X(func.ST_AsText(Claim.location)), func.ST_Y(func.ST_AsText(Claim.location)))
-        .where(Claim.id == claim.id)
-    )
-    lon, lat = result.scalar()
+    await map_cache.invalidate_claim(claim.lat, claim.lon, claim.owner_id)
     
     return ClaimOut(
         id=str(claim.id),
         owner_id=str(claim.owner_id),
         address_label=claim.address_label,
-        lat=float(lat),
-        lon=float(lon),
+        lat=claim.lat,
+        lon=claim.lon,
     )
 
 
 @app.get("/my-claims", response_model=List[dict])
-async def my_claims(session: AsyncSession = Depends(get_session), current_user: User = Depends(get_current_user)):
-    """Get all claims owned by the current user with their builds."""
+async def my_claims(session: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    """Get all claims owned by the current user with their builds.
+
+    Read from the primary so a claim created or deleted by this user shows
+    up at once, in the response and in the cached copy.
+    """
+    cache_key = map_cache.my_claims_key(current_user.id)
+    cached = await map_cache.get(cache_key)
+    if cached is not None:
+        return cached
     result = await session.execute(
-        select(Claim, func.ST_X(func.ST_AsText(Claim.location)), func.ST_Y(func.ST_AsText(Claim.location)))
+        select(Claim.id, Claim.owner_id, Claim.address_label, Claim.lat, Claim.lon, Claim.created_at)
         .where(Claim.owner_id == current_user.id)
     )
     rows = result.all()
+    builds_by_claim = await _builds_by_claim(session, [claim.id for claim in rows])
     claims = []
-    for claim, lon, lat in rows:
-        # Get builds for this claim
-        builds_result = await session.execute(select(Build).where(Build.claim_id == claim.id))
-        builds = builds_result.scalars().all()
+    for claim in rows:
+        builds = builds_by_claim.get(claim.id, [])
         
         claims.append({
             "id": str(claim.id),
             "owner_id": str(claim.owner_id),
             "address_label": claim.address_label,
-            "lat": float(lat),
-            "lon": float(lon),
+            "lat": claim.lat,
+            "lon": claim.lon,
             "created_at": claim.created_at.isoformat(),
             "builds": [
                 {
@@ -465,6 +687,7 @@ async def my_claims(session: AsyncSession = Depends(get_session), current_user:
                 } for b in builds
             ]
         })
+    await map_cache.set(cache_key, claims)
     return claims
 
 
@@ -472,7 +695,7 @@ async def my_claims(session: AsyncSession = Depends(get_session), current_user:
 async def update_build(
     build_id: str,
     payload: BuildCreate,
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """Update a build's properties (prefab, flag, decal, height_m).
@@ -502,12 +725,12 @@ async def update_build(
     build.height_m = payload.height_m
     
     await session.commit()
-    await session.refresh(build)
+    await map_cache.invalidate_claim(claim.lat, claim.lon, claim.owner_id)
     return build
 
 
 @app.post("/builds", response_model=BuildOut)
-async def create_build(payload: BuildCreate, session: AsyncSession = Depends(get_session)):
+async def create_build(payload: BuildCreate, session: AsyncSession = Depends(get_db)):
     # simple existence + per-claim single build for now
     claim = await session.get(Claim, payload.claim_id)
     if not claim:
@@ -525,5 +748,5 @@ async def create_build(payload: BuildCreate, session: AsyncSession = Depends(get
     )
     session.add(build)
     await session.commit()
-    await session.refresh(build)
+    await map_cache.invalidate_claim(claim.lat, claim.lon, claim.owner_id)
     return build
@@ -0,0 +1,163 @@
+"""Micro-batched persistence of chat messages."""
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from .config import settings
+from .database import AsyncSessionLocal
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_ASYNC = "async"
+DURABILITY_SYNC = "sync"
+
+
+class MessageWriter:
+    """
+    Collects Message rows and writes them with one multi-row INSERT per batch.
+
+    Rows get their id and created_at when they are built, so callers can
+    broadcast a message before it reaches the database. A batch is flushed
+    once it holds batch_size rows or flush_interval seconds after its first
+    row, whichever comes first. A batch that fails is retried one row at a
+    time, so a bad row only loses itself. Callers that need durability can
+    await the flush that contains their row; otherwise a row that cannot be
+    written is logged and lost. Readers that load a room from the table can watch it to
+    also get the rows not committed yet.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal, batch_size: int = 200, flush_interval: float = 0.05):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[Tuple[dict, Optional[asyncio.Future]]] = []
+        self._flushing: List[dict] = []
+        self._watchers: Dict[str, List[List[dict]]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.flushed_batches = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+
+    @staticmethod
+    def new_message(sender_id, room_id, body: str, attachment_url: Optional[str] = None, attachment_type: Optional[str] = None) -> dict:
+        return {
+            "id": uuid.uuid4(),
+            "sender_id": sender_id,
+            "room_id": room_id,
+            "body": body,
+            "attachment_url": attachment_url,
+            "attachment_type": attachment_type,
+            "created_at": datetime.utcnow(),
+        }
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def submit(self, row: dict, wait: bool = False):
+        """Queue a row. With wait=True, return only once it is committed (or raise)."""
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._pending.append((row, future))
+        for rows in self._watchers.get(str(row["room_id"]), ()):
+            rows.append(row)
+        if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        if self._task is None:
+            # Not started (e.g. outside the app lifecycle): write through
+            await self.flush()
+        if future is not None:
+            await future
+
+    def watch(self, room_id) -> List[dict]:
+        """
+        The rows of a room that are queued or being flushed, as a list that
+        also receives every row submitted for the room until unwatch.
+        """
+        key = str(room_id)
+        rows = [row for row in self._flushing if str(row["room_id"]) == key]
+        rows.extend(row for row, _ in self._pending if str(row["room_id"]) == key)
+        self._watchers.setdefault(key, []).append(rows)
+        return rows
+
+    def unwatch(self, room_id, rows: List[dict]):
+        key = str(room_id)
+        watchers = self._watchers.get(key, [])
+        watchers[:] = [watcher for watcher in watchers if watcher is not rows]
+        if not watchers:
+            self._watchers.pop(key, None)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _insert(self, rows: List[dict]):
+        async with self.session_factory() as session:
+            await session.execute(insert(Message).values(rows))
+            await session.commit()
+
+    async def flush(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            rows = [row for row, _ in batch]
+            self._flushing = rows
+            try:
+                await self._insert(rows)
+            except Exception as e:
+                logger.warning("failed to persist %d chat messages, retrying one by one: %s", len(rows), e)
+                await self._insert_each(batch)
+                continue
+            finally:
+                self._flushing = []
+            self.flushed_batches += 1
+            self.flushed_rows += len(rows)
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+    async def _insert_each(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        # So one bad row costs only itself, not the rest of its batch
+        for row, future in batch:
+            try:
+                await self._insert([row])
+            except Exception as e:
+                self.failed_rows += 1
+                logger.error("failed to persist chat message %s: %s", row["id"], e)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                continue
+            self.flushed_rows += 1
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "flushed_batches": self.flushed_batches,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+        }
+
+
+message_writer = MessageWriter(
+    batch_size=settings.chat_write_batch_size,
+    flush_interval=settings.chat_write_flush_ms / 1000.0,
+)
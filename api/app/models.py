@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 
 from geoalchemy2 import Geography
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, UniqueConstraint, Text
+from sqlalchemy import Boolean, Column, Computed, DateTime, Float, ForeignKey, Index, Integer, String, UniqueConstraint, Text, func
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 
@@ -22,13 +22,69 @@ class User(Base):
 
     claims = relationship("Claim", back_populates="owner", cascade="all, delete")
 
+# Minimum distance between two claims.
+CLAIM_MIN_SPACING_M = 20
+# Side of the grid cells claims are keyed by, in Web Mercator meters. Ground
+# size shrinks with cos(latitude), so a cell's diagonal stays under
+# CLAIM_MIN_SPACING_M everywhere and two claims never legitimately share one.
+CLAIM_CELL_SIZE_M = 14
+
+
+def claim_grid_cell_sql(location: str) -> str:
+    """SQL expression for the grid cell key of a geography point expression."""
+    merc = f"ST_Transform(({location})::geometry, 3857)"
+    return (
+        f"(floor(ST_X({merc}) / {CLAIM_CELL_SIZE_M})::bigint || ':' || "
+        f"floor(ST_Y({merc}) / {CLAIM_CELL_SIZE_M})::bigint)"
+    )
+
+
+# Side of the coarser grid used to serialize claims that could conflict, in
+# Web Mercator meters. See claim_lock_sql.
+CLAIM_LOCK_CELL_SIZE_M = 64
+_CLAIM_LOCK_NAMESPACE = 0x7475
+
+
+def claim_lock_sql(location: str) -> str:
+    """
+    SQL statement taking transaction advisory locks for a claim at a geography
+    point expression, in key order so concurrent claimers cannot deadlock.
+
+    A claim locks every lock-grid cell its spacing disc overlaps, so two
+    claims closer than CLAIM_MIN_SPACING_M always share a lock, whichever
+    grid cells they fall in. The disc radius is widened a little for the
+    Mercator scale and the sphere/spheroid difference, and capped near the
+    poles.
+    """
+    size = CLAIM_LOCK_CELL_SIZE_M
+    return f"""
+    SELECT pg_advisory_xact_lock(key) FROM (
+        SELECT DISTINCT ({_CLAIM_LOCK_NAMESPACE}::bigint << 48) | ((cx & 16777215) << 24) | (cy & 16777215) AS key
+        FROM (
+            SELECT ST_X(m) AS x, ST_Y(m) AS y,
+                   1.1 * {CLAIM_MIN_SPACING_M} / greatest(cos(radians(ST_Y(g::geometry))), 0.05) AS r
+            FROM (SELECT g, ST_Transform(g::geometry, 3857) AS m FROM (SELECT {location} AS g) AS src) AS point
+        ) AS disc
+        CROSS JOIN LATERAL generate_series(floor((x - r) / {size})::bigint, floor((x + r) / {size})::bigint) AS cx
+        CROSS JOIN LATERAL generate_series(floor((y - r) / {size})::bigint, floor((y + r) / {size})::bigint) AS cy
+    ) AS keys
+    ORDER BY key
+    """
+
+
 class Claim(Base):
     __tablename__ = "claims"
+    __table_args__ = (UniqueConstraint("grid_cell", name="uq_claims_grid_cell"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     owner_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     address_label = Column(String(255), nullable=False)
     location = Column(Geography(geometry_type="POINT", srid=4326), nullable=False)
+    # Coordinates kept by Postgres so reads need no geography decoding
+    lat = Column(Float, Computed("ST_Y(location::geometry)", persisted=True))
+    lon = Column(Float, Computed("ST_X(location::geometry)", persisted=True))
+    # See claim_grid_cell_sql; NULL only for legacy rows that share a cell.
+    grid_cell = Column(String(32), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     owner = relationship("User", back_populates="claims")
@@ -37,17 +93,50 @@ class Claim(Base):
 
 class Connection(Base):
     __tablename__ = "connections"
-    __table_args__ = (UniqueConstraint("requester_id", "addressee_id", name="uq_connection_pair"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     requester_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     addressee_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     status = Column(String(20), default="pending")  # pending, accepted, blocked
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Set once the connection's friend_edges exist; see FriendshipService.link
+    edges_linked = Column(Boolean, default=False, server_default="false", nullable=False)
+    # Accepted pairs in canonical (least, greatest) order, so a friendship is
+    # found from either user without an OR across both columns.
+    __table_args__ = (
+        UniqueConstraint("requester_id", "addressee_id", name="uq_connection_pair"),
+        Index(
+            "ix_connections_accepted_pair",
+            func.least(requester_id, addressee_id),
+            func.greatest(requester_id, addressee_id),
+            postgresql_where=status == "accepted",
+        ),
+        # Paged listings per direction, newest first
+        Index("ix_connections_requester_status", requester_id, status, created_at, id),
+        Index("ix_connections_addressee_status", addressee_id, status, created_at, id),
+    )
+
+
+class FriendEdge(Base):
+    """
+    Adjacency rows for accepted connections, one per direction.
+
+    A user's friends are a single range scan on user_id, and mutual friends
+    of two users join two such ranges. created_at is the connection's, so
+    edges page with the same cursor as connections.
+    """
+    __tablename__ = "friend_edges"
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    friend_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    connection_id = Column(UUID(as_uuid=True), ForeignKey("connections.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index("ix_friend_edges_user_created", user_id, created_at, connection_id),)
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (Index("ix_messages_room_created", "room_id", "created_at", "id"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     sender_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
@@ -107,18 +196,27 @@ class SupplyPath(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     friend_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
     geom = Column(Geography(geometry_type="LINESTRING", srid=4326), nullable=False)
-    health = Column(Integer, default=30, nullable=False)  # days remaining
+    # Days remaining as of last_touch: the lifetime when touched, 0 once
+    # PathDecay has swept the expired path. Read the current value through
+    # PathDecay.health_expression(), which counts down from last_touch.
+    health = Column(Integer, default=30, nullable=False)
     last_touch = Column(DateTime, default=datetime.utcnow, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    __table_args__ = (UniqueConstraint("user_id", "friend_id", name="uq_supply_path_pair"),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "friend_id", name="uq_supply_path_pair"),
+        Index("ix_supply_paths_live_touch", last_touch, postgresql_where=health > 0),
+    )
 
 
 class VisibleArea(Base):
     __tablename__ = "visible_areas"
+    __table_args__ = (UniqueConstraint("user_id", "source", name="uq_visible_area_source"),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"))
+    source = Column(String(20), default="all", nullable=False)  # claims, friends, paths, all
     geom = Column(Geography(geometry_type="MULTIPOLYGON", srid=4326), nullable=True)
+    source_count = Column(Integer, default=0, nullable=False)
     refreshed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 class Build(Base):
@@ -144,3 +242,65 @@ class RoomAccess(Base):
     room_id = Column(String(255), nullable=False)  # room_id is a string (UUID or custom)
     accessed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     last_accessed = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+# Idempotent DDL applied on startup. create_all() only creates missing tables,
+# so indexes and columns added to existing tables are listed here as well.
+SCHEMA_PATCHES = [
+    # Radius searches on claims (create_all adds this for new tables only).
+    "CREATE INDEX IF NOT EXISTS idx_claims_location ON claims USING gist (location)",
+    # Tile queries filter on the planar bbox of the claim location.
+    "CREATE INDEX IF NOT EXISTS ix_claims_location_geom ON claims USING gist ((location::geometry))",
+    # Materialized visibility pieces, one row per (user, source).
+    "ALTER TABLE visible_areas ADD COLUMN IF NOT EXISTS source VARCHAR(20) NOT NULL DEFAULT 'all'",
+    "ALTER TABLE visible_areas ADD COLUMN IF NOT EXISTS source_count INTEGER NOT NULL DEFAULT 0",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_visible_area_source ON visible_areas (user_id, source)",
+    # Keyset pagination of room history.
+    "CREATE INDEX IF NOT EXISTS ix_messages_room_created ON messages (room_id, created_at, id)",
+    # Grid cell key for claims. The backfill keys the oldest claim of each cell
+    # and leaves later claims in an occupied cell NULL, so the unique index
+    # can always be built. It only visits unkeyed rows through the partial
+    # index, so after the first run it costs little on each startup while
+    # still keying claims written by workers that predate the column.
+    "ALTER TABLE claims ADD COLUMN IF NOT EXISTS grid_cell VARCHAR(32)",
+    "CREATE INDEX IF NOT EXISTS ix_claims_unkeyed ON claims (id) WHERE grid_cell IS NULL",
+    f"""
+    UPDATE claims SET grid_cell = ranked.cell
+    FROM (
+        SELECT id, cell, row_number() OVER (PARTITION BY cell ORDER BY created_at, id) AS rn
+        FROM (SELECT id, created_at, {claim_grid_cell_sql("location")} AS cell FROM claims WHERE grid_cell IS NULL) AS keyed
+        WHERE NOT EXISTS (SELECT 1 FROM claims taken WHERE taken.grid_cell = keyed.cell)
+    ) AS ranked
+    WHERE claims.id = ranked.id AND ranked.rn = 1
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_claims_grid_cell ON claims (grid_cell)",
+    # Stored claim coordinates (rewrites the table once).
+    "ALTER TABLE claims ADD COLUMN IF NOT EXISTS lat DOUBLE PRECISION GENERATED ALWAYS AS (ST_Y(location::geometry)) STORED",
+    "ALTER TABLE claims ADD COLUMN IF NOT EXISTS lon DOUBLE PRECISION GENERATED ALWAYS AS (ST_X(location::geometry)) STORED",
+    # Unswept supply paths by age, for the decay sweep.
+    "CREATE INDEX IF NOT EXISTS ix_supply_paths_live_touch ON supply_paths (last_touch) WHERE health > 0",
+    # Friendship lookups by canonical user pair.
+    "CREATE INDEX IF NOT EXISTS ix_connections_accepted_pair ON connections "
+    "(LEAST(requester_id, addressee_id), GREATEST(requester_id, addressee_id)) WHERE status = 'accepted'",
+    # Connection listing per direction, and the friend_edges adjacency table
+    # (kept by approve). The backfill links accepted connections that have no
+    # edges yet: all of them on the first run, then only those approved by a
+    # worker still running older code during a rolling deploy. It visits them
+    # through a partial index, so on most startups it reads nothing.
+    "CREATE INDEX IF NOT EXISTS ix_connections_requester_status ON connections (requester_id, status, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_connections_addressee_status ON connections (addressee_id, status, created_at, id)",
+    "ALTER TABLE connections ADD COLUMN IF NOT EXISTS edges_linked BOOLEAN NOT NULL DEFAULT false",
+    "CREATE INDEX IF NOT EXISTS ix_connections_unlinked ON connections (id) WHERE status = 'accepted' AND NOT edges_linked",
+    """
+    WITH linked AS (
+        UPDATE connections SET edges_linked = true
+        WHERE status = 'accepted' AND NOT edges_linked
+        RETURNING id, requester_id, addressee_id, created_at
+    )
+    INSERT INTO friend_edges (user_id, friend_id, connection_id, created_at)
+    SELECT requester_id, addressee_id, id, created_at FROM linked
+    UNION ALL
+    SELECT addressee_id, requester_id, id, created_at FROM linked
+    ON CONFLICT DO NOTHING
+    """,
+]
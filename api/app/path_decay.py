@@ -0,0 +1,135 @@
+"""Expiry of supply paths that have not been touched within their lifetime."""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import Integer, cast, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import AsyncSessionLocal
+from .models import SupplyPath
+from .visibility import visibility_engine
+
+logger = logging.getLogger(__name__)
+
+# Called with a session and the users whose paths just expired, inside the
+# sweep's transaction (the sweep commits afterwards).
+ExpiryHandler = Callable[[AsyncSession, List], Awaitable[None]]
+
+# Marks one batch of newly dead paths as swept. Live rows are the only ones in
+# ix_supply_paths_live_touch, so this never visits paths swept earlier.
+_SWEEP_BATCH = text(
+    """
+    UPDATE supply_paths SET health = 0
+    WHERE id IN (
+        SELECT id FROM supply_paths
+        WHERE health > 0 AND last_touch <= :cutoff
+        ORDER BY last_touch
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING user_id
+    """
+)
+
+
+class PathDecay:
+    """
+    Expires supply paths lazily, with a periodic sweep for side effects.
+
+    Whether a path is live follows from last_touch alone, so readers such as
+    the visibility engine need no stored countdown, and a path's days
+    remaining are derived when read (health_expression). The stored health
+    column only records whether a path has been swept yet: touch_path sets it
+    to the lifetime, and each sweep sets it to 0 for paths that died since the
+    last sweep, in batches, and reports their owners to on_expired. Each tick costs
+    O(expired paths), not O(all paths). Several workers can sweep at once;
+    SKIP LOCKED keeps them off each other's rows.
+    """
+
+    def __init__(
+        self,
+        on_expired: ExpiryHandler,
+        session_factory=AsyncSessionLocal,
+        lifetime_days: int = 30,
+        interval: float = 300.0,
+        batch_size: int = 1000,
+    ):
+        self.on_expired = on_expired
+        self.session_factory = session_factory
+        self.lifetime_days = lifetime_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.sweeps = 0
+        self.expired_paths = 0
+        self.last_sweep_ms = 0.0
+
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        """Paths last touched at or before this instant are dead."""
+        return (now or datetime.utcnow()) - timedelta(days=self.lifetime_days)
+
+    def health_expression(self):
+        """SQL for a path's days remaining: lifetime minus whole days since last_touch, at least 0."""
+        elapsed = func.extract("day", func.timezone("utc", func.now()) - SupplyPath.last_touch)
+        return func.greatest(self.lifetime_days - cast(elapsed, Integer), 0)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning("supply path sweep failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """Mark every path that died since the last sweep and notify; return the count."""
+        started = time.perf_counter()
+        cutoff = self.cutoff()
+        expired = 0
+        while True:
+            async with self.session_factory() as session:
+                result = await session.execute(_SWEEP_BATCH, {"cutoff": cutoff, "batch_size": self.batch_size})
+                user_ids = [row[0] for row in result.all()]
+                # Same transaction: if notifying fails, the batch rolls back
+                # and the next tick sweeps it again.
+                if user_ids:
+                    await self.on_expired(session, list(set(user_ids)))
+                await session.commit()
+            expired += len(user_ids)
+            if len(user_ids) < self.batch_size:
+                break
+        self.sweeps += 1
+        self.expired_paths += expired
+        self.last_sweep_ms = (time.perf_counter() - started) * 1000
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            "sweeps": self.sweeps,
+            "expired_paths": self.expired_paths,
+            "last_sweep_ms": round(self.last_sweep_ms, 3),
+        }
+
+
+path_decay = PathDecay(
+    visibility_engine.on_paths_changed,
+    lifetime_days=settings.supply_path_lifetime_days,
+    interval=settings.supply_path_sweep_seconds,
+    batch_size=settings.supply_path_sweep_batch_size,
+)
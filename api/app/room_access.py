@@ -0,0 +1,165 @@
+"""Buffered tracking of when users last opened each chat room."""
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from .config import settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# One multi-row upsert per batch. Rows for users deleted since they were
+# recorded are skipped instead of failing the whole batch on the foreign key.
+_UPSERT = text(
+    """
+    INSERT INTO room_access (id, user_id, room_id, accessed_at, last_accessed)
+    SELECT a.id, a.user_id, a.room_id, a.at, a.at
+    FROM unnest(
+        CAST(:ids AS uuid[]), CAST(:user_ids AS uuid[]), CAST(:room_ids AS text[]), CAST(:ats AS timestamp[])
+    ) AS a(id, user_id, room_id, at)
+    WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = a.user_id)
+    ON CONFLICT (user_id, room_id)
+    DO UPDATE SET last_accessed = GREATEST(room_access.last_accessed, EXCLUDED.last_accessed)
+    """
+)
+
+
+class RoomAccessTracker:
+    """
+    Coalesces room access events in memory and upserts them periodically.
+
+    Only the latest access per (user, room) is kept, so a client reopening a
+    room many times between flushes costs one row. Entries are flushed every
+    flush_interval seconds, or sooner once max_pending keys are waiting.
+    Unflushed entries are lost if the process dies; readers merge them in via
+    pending_for so a user's own history is never behind.
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        flush_interval: float = 5.0,
+        max_pending: int = 5000,
+        batch_size: int = 1000,
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._pending: Dict[str, Dict[str, datetime]] = {}
+        self._flushing: Dict[str, Dict[str, datetime]] = {}
+        self._count = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def record(self, user_id, room_id: str, at: Optional[datetime] = None):
+        """Note that user_id opened room_id (now, unless at is given)."""
+        at = at or datetime.utcnow()
+        rooms = self._pending.setdefault(str(user_id), {})
+        previous = rooms.get(room_id)
+        if previous is None:
+            self._count += 1
+        if previous is None or at > previous:
+            rooms[room_id] = at
+        self.recorded += 1
+        if self._task is None:
+            # Not started (e.g. outside the app lifecycle): write through
+            await self.flush()
+        elif self._count >= self.max_pending:
+            self._wakeup.set()
+
+    def pending_for(self, user_id) -> Dict[str, datetime]:
+        """Unflushed room_id -> last access time for one user, including a flush in flight."""
+        key = str(user_id)
+        merged = dict(self._flushing.get(key, {}))
+        for room_id, at in self._pending.get(key, {}).items():
+            if room_id not in merged or at > merged[room_id]:
+                merged[room_id] = at
+        return merged
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _merge_back(self, rows: List[Tuple[str, str, datetime]]):
+        # Requeue a failed batch without overwriting accesses recorded since
+        for user_id, room_id, at in rows:
+            rooms = self._pending.setdefault(user_id, {})
+            previous = rooms.get(room_id)
+            if previous is None:
+                self._count += 1
+                rooms[room_id] = at
+            elif at > previous:
+                rooms[room_id] = at
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending, self._count = self._pending, {}, 0
+        self._flushing = pending
+        rows = [(user_id, room_id, at) for user_id, rooms in pending.items() for room_id, at in rooms.items()]
+        try:
+            await self._write(rows)
+        finally:
+            self._flushing = {}
+
+    async def _write(self, rows: List[Tuple[str, str, datetime]]):
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            try:
+                async with self.session_factory() as session:
+                    await session.execute(
+                        _UPSERT,
+                        {
+                            "ids": [uuid.uuid4() for _ in batch],
+                            "user_ids": [user_id for user_id, _, _ in batch],
+                            "room_ids": [room_id for _, room_id, _ in batch],
+                            "ats": [at for _, _, at in batch],
+                        },
+                    )
+                    await session.commit()
+            except Exception as e:
+                logger.error("failed to persist %d room accesses: %s", len(batch), e)
+                self.failed_rows += len(batch)
+                self._merge_back(rows[start:])
+                return
+            self.flushed_rows += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._count,
+            "recorded": self.recorded,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+        }
+
+
+room_access = RoomAccessTracker(
+    flush_interval=settings.room_access_flush_seconds,
+    max_pending=settings.room_access_max_pending,
+)
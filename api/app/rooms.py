@@ -0,0 +1,73 @@
+"""Cached chat room membership checks."""
+import uuid
+from typing import FrozenSet, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import TTLCache
+from .config import settings
+from .models import ChatMember
+
+
+class RoomMembership:
+    """
+    Answers "is this user in this room" from a per-room member set.
+
+    A room's members are loaded in one query on first use and kept in a
+    bounded LRU/TTL cache, so members pass the check without touching the
+    database. A user missing from a cached set is looked up by their own
+    membership row before the check fails, so members added by another worker
+    are never refused and a non-member costs one probe of the (room, user)
+    unique index rather than a reload of the whole room. Joins on this worker
+    invalidate the room directly.
+    """
+
+    def __init__(self, cache: TTLCache):
+        self.cache = cache
+        self.miss_checks = 0
+
+    @staticmethod
+    def _key(room_id) -> Optional[str]:
+        try:
+            return str(uuid.UUID(str(room_id)))
+        except ValueError:
+            return None
+
+    async def _load(self, db: AsyncSession, key: str) -> FrozenSet[str]:
+        result = await db.execute(select(ChatMember.user_id).where(ChatMember.room_id == key))
+        members = frozenset(str(user_id) for user_id in result.scalars().all())
+        self.cache.set(key, members)
+        return members
+
+    async def is_member(self, db: AsyncSession, room_id, user_id) -> bool:
+        key = self._key(room_id)
+        user = self._key(user_id)
+        if key is None or user is None:
+            return False
+        members = self.cache.get(key)
+        if members is None:
+            return user in await self._load(db, key)
+        if user in members:
+            return True
+        self.miss_checks += 1
+        result = await db.execute(
+            select(ChatMember.user_id).where(ChatMember.room_id == key, ChatMember.user_id == user)
+        )
+        if result.first() is None:
+            return False
+        self.cache.set(key, members | {user})
+        return True
+
+    def invalidate(self, room_id):
+        key = self._key(room_id)
+        if key is not None:
+            self.cache.pop(key)
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "miss_checks": self.miss_checks}
+
+
+room_members = RoomMembership(
+    TTLCache(settings.room_member_cache_max_entries, settings.room_member_cache_ttl_seconds)
+)
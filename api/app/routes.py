@@ -1,20 +1,32 @@
 from datetime import datetime, timedelta
 from typing import List, Optional
-from uuid import UUID
-import hashlib
+from uuid import UUID, uuid4
+import base64
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, status
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import and_, or_, select, func
+from pydantic import ValidationError
+from sqlalchemy import and_, or_, select, func, tuple_, union_all
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from . import schemas
+from .chat_history import recent_messages, room_uuid as chat_room_uuid
 from .chat_manager import manager
-from .deps import get_current_user, get_db
-from .models import Build, Claim, Connection, Inventory, Message, StoreItem, User, ChatRoom, ChatMember, SupplyPath, VisibleArea, RoomAccess
-from .security import create_access_token, get_password_hash, verify_password, decode_token, verify_google_token
+from .config import settings
+from .database import AsyncSessionLocal
+from .geo import decimal_digits_for, pixel_size_degrees
+from .message_writer import DURABILITY_SYNC, message_writer
+from .deps import get_current_user, get_db, get_read_db, invalidate_user, load_user
+from .friends import friendships
+from .room_access import room_access
+from .rooms import room_members
+from .path_decay import path_decay
+from .models import Build, Claim, Connection, FriendEdge, Inventory, Message, StoreItem, User, ChatRoom, ChatMember, SupplyPath, VisibleArea, RoomAccess
+from .security import create_access_token, get_password_hash_async, verify_password_async, decode_token, verify_google_token
+from .visibility import visibility_engine
 
 router = APIRouter()
 
@@ -43,10 +55,11 @@ async def google_auth(request: Request, db: AsyncSession = Depends(get_db)):
     
     if not user:
         # Create new user from Google
+        placeholder_hash = await get_password_hash_async("google_oauth")  # Placeholder
         user = User(
             handle=google_user["email"].split("@")[0],
             email=google_user["email"],
-            password_hash=get_password_hash("google_oauth"),  # Placeholder
+            password_hash=placeholder_hash,
         )
         db.add(user)
         try:
@@ -59,7 +72,7 @@ async def google_auth(request: Request, db: AsyncSession = Depends(get_db)):
                 user = User(
                     handle=f"{base_handle}{i}",
                     email=google_user["email"],
-                    password_hash=get_password_hash("google_oauth"),
+                    password_hash=placeholder_hash,
                 )
                 db.add(user)
                 try:
@@ -104,7 +117,7 @@ async def register(request: Request, db: AsyncSession = Depends(get_db)):
     if len(handle) < 3 or len(handle) > 30:
         return RedirectResponse(url="/register?error=invalid_handle_length", status_code=302)
     
-    user = User(handle=handle, email=email, password_hash=get_password_hash(password))
+    user = User(handle=handle, email=email, password_hash=await get_password_hash_async(password))
     db.add(user)
     try:
         await db.commit()
@@ -126,7 +139,7 @@ async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends
     """
     result = await db.execute(select(User).where(or_(User.email == form_data.username, User.handle == form_data.username)))
     user = result.scalars().first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+    if not user or not await verify_password_async(form_data.password, user.password_hash):
         return RedirectResponse(url="/login?error=invalid_credentials", status_code=302)
     
     token = create_access_token({"sub": str(user.id)}, expires_delta=timedelta(days=7))
@@ -153,7 +166,7 @@ async def api_login(login_data: schemas.LoginRequest, db: AsyncSession = Depends
     """
     result = await db.execute(select(User).where(or_(User.email == login_data.username, User.handle == login_data.username)))
     user = result.scalars().first()
-    if not user or not verify_password(login_data.password, user.password_hash):
+    if not user or not await verify_password_async(login_data.password, user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     
     token = create_access_token({"sub": str(user.id)}, expires_delta=timedelta(days=7))
@@ -177,7 +190,7 @@ async def api_register(user_data: schemas.UserCreate, db: AsyncSession = Depends
     if len(user_data.handle) < 3 or len(user_data.handle) > 30:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Handle must be 3-30 characters")
     
-    user = User(handle=user_data.handle, email=user_data.email, password_hash=get_password_hash(user_data.password))
+    user = User(handle=user_data.handle, email=user_data.email, password_hash=await get_password_hash_async(user_data.password))
     db.add(user)
     try:
         await db.commit()
@@ -226,13 +239,15 @@ async def update_profile(update: schemas.ProfileUpdate, db: AsyncSession = Depen
     - **bio**: User biography (optional)
     - **avatar_url**: URL to avatar image (optional)
     """
+    user = await db.get(User, current.id)
     if update.bio is not None:
-        current.bio = update.bio
+        user.bio = update.bio
     if update.avatar_url is not None:
-        current.avatar_url = update.avatar_url
+        user.avatar_url = update.avatar_url
     await db.commit()
-    await db.refresh(current)
-    return current
+    await db.refresh(user)
+    invalidate_user(user.id)
+    return user
 
 
 @router.get("/users/{user_id}", response_model=schemas.UserOut, tags=["Users"])
@@ -276,10 +291,12 @@ async def verify_user(user_id: str, db: AsyncSession = Depends(get_db), current:
     if str(current.id) != user_id:
         raise HTTPException(status_code=403, detail="can only verify yourself")
     
-    current.verified = True
+    user = await db.get(User, current.id)
+    user.verified = True
     await db.commit()
-    await db.refresh(current)
-    return current
+    await db.refresh(user)
+    invalidate_user(user.id)
+    return user
 
 
 @router.post("/connections", response_model=schemas.ConnectionOut, tags=["Connections"])
@@ -302,6 +319,7 @@ async def request_connection(payload: schemas.ConnectionCreate, db: AsyncSession
         await db.rollback()
         raise HTTPException(status_code=400, detail="already requested")
     await db.refresh(conn)
+    friendships.invalidate(conn.requester_id, conn.addressee_id)
     return conn
 
 
@@ -319,21 +337,83 @@ async def approve_connection(connection_id: str, db: AsyncSession = Depends(get_
     if not conn or str(conn.addressee_id) != str(current.id):
         raise HTTPException(status_code=404, detail="not found")
     conn.status = "accepted"
+    await friendships.link(db, conn)
+    await visibility_engine.on_connection_changed(db, conn.requester_id, conn.addressee_id)
     await db.commit()
-    await db.refresh(conn)
+    friendships.invalidate(conn.requester_id, conn.addressee_id)
     return conn
 
 
 @router.get("/connections", response_model=List[schemas.ConnectionOut], tags=["Connections"])
-async def list_connections(db: AsyncSession = Depends(get_db), current: User = Depends(get_current_user)):
+async def list_connections(
+    status_filter: Optional[str] = Query(None, alias="status", pattern="^(pending|accepted|blocked)$"),
+    direction: str = Query("all", pattern="^(all|incoming|outgoing)$"),
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[str] = Query(None),
+    mutual: bool = Query(False),
+    db: AsyncSession = Depends(get_read_db),
+    current: User = Depends(get_current_user),
+):
     """
-    List all connections for the current user.
+    List connections of the current user, newest first.
+    
+    Every connection carries a `cursor`; pass the last one as `before` to get
+    the next page.
     
-    Returns both sent and received connection requests.
-    Includes pending and accepted connections.
+    - **status**: Only `pending`, `accepted` or `blocked` connections
+    - **direction**: `incoming` (requests to you), `outgoing` (your requests) or `all`
+    - **limit**: Page size (default 50, max 200)
+    - **before**: Cursor; return connections older than it
+    - **mutual**: Include `mutual_friends`, the number of friends you share with the other user
     """
-    result = await db.execute(select(Connection).where(or_(Connection.requester_id == current.id, Connection.addressee_id == current.id)))
-    return result.scalars().all()
+    cursor = decode_cursor(before) if before else None
+    if status_filter == "accepted" and direction == "all":
+        # Friends are one range scan of the adjacency table
+        query = (
+            select(Connection)
+            .join(FriendEdge, FriendEdge.connection_id == Connection.id)
+            .where(FriendEdge.user_id == current.id)
+        )
+        if cursor:
+            query = query.where(tuple_(FriendEdge.created_at, FriendEdge.connection_id) < tuple_(*cursor))
+        query = query.order_by(FriendEdge.created_at.desc(), FriendEdge.connection_id.desc()).limit(limit)
+    else:
+        sides = {
+            "outgoing": [Connection.requester_id],
+            "incoming": [Connection.addressee_id],
+            "all": [Connection.requester_id, Connection.addressee_id],
+        }[direction]
+        # One index-ordered page per direction, merged below
+        pages = []
+        for column in sides:
+            page = select(Connection).where(column == current.id)
+            if status_filter:
+                page = page.where(Connection.status == status_filter)
+            if cursor:
+                page = page.where(tuple_(Connection.created_at, Connection.id) < tuple_(*cursor))
+            pages.append(page.order_by(Connection.created_at.desc(), Connection.id.desc()).limit(limit))
+        if len(pages) == 1:
+            query = pages[0]
+        else:
+            merged = union_all(*pages).subquery()
+            row = aliased(Connection, merged)
+            query = select(row).order_by(merged.c.created_at.desc(), merged.c.id.desc()).limit(limit)
+    result = await db.execute(query)
+    connections = result.scalars().all()
+
+    mutual_counts = {}
+    if mutual and connections:
+        others = [c.addressee_id if c.requester_id == current.id else c.requester_id for c in connections]
+        mutual_counts = await friendships.mutual_counts(db, current.id, others)
+    out = []
+    for c in connections:
+        other = c.addressee_id if c.requester_id == current.id else c.requester_id
+        item = schemas.ConnectionOut.from_orm(c)
+        item.cursor = encode_cursor(c.created_at, c.id)
+        if mutual:
+            item.mutual_friends = mutual_counts.get(str(other), 0)
+        out.append(item)
+    return out
 
 
 @router.post("/chatrooms", response_model=schemas.ChatRoomOut, tags=["Chat"])
@@ -349,11 +429,10 @@ async def create_room(payload: schemas.ChatRoomCreate, db: AsyncSession = Depend
     - **member_ids**: List of user IDs to invite
     - **is_group**: Whether this is a group chat (true) or direct message (false)
     """
-    # enforce friendship for each invited member
-    for uid in payload.member_ids:
-        res = await db.execute(select(Connection).where(and_(Connection.status == "accepted", or_(and_(Connection.requester_id == current.id, Connection.addressee_id == uid), and_(Connection.addressee_id == current.id, Connection.requester_id == uid)))))
-        if not res.scalars().first():
-            raise HTTPException(status_code=403, detail=f"not connected to {uid}")
+    # enforce friendship for every invited member in one lookup
+    missing = await friendships.not_friends(db, current.id, payload.member_ids)
+    if missing:
+        raise HTTPException(status_code=403, detail=f"not connected to {missing[0]}")
     room = ChatRoom(name=payload.name, is_group=payload.is_group)
     db.add(room)
     await db.flush()
@@ -362,6 +441,7 @@ async def create_room(payload: schemas.ChatRoomCreate, db: AsyncSession = Depend
         db.add(ChatMember(room_id=room.id, user_id=uid))
     await db.commit()
     await db.refresh(room)
+    room_members.invalidate(room.id)
     return room
 
 
@@ -388,32 +468,18 @@ async def top_rooms(limit: int = 10):
 
 
 @router.post("/chatrooms/access", tags=["Chat"])
-async def track_room_access(room_id: str = Query(...), db: AsyncSession = Depends(get_db), current: User = Depends(get_current_user)):
+async def track_room_access(room_id: str = Query(..., max_length=255), current: User = Depends(get_current_user)):
     """
     Track user's room access for room history.
     
     Records when a user accesses a chat room to build their previous rooms list.
+    Accesses are buffered and written in batches; /chatrooms/previous already
+    includes the unwritten ones.
     """
     if not room_id or room_id == "demo-room":
         return {"status": "ok"}
     
-    # Try to find existing access record
-    result = await db.execute(
-        select(RoomAccess).where(
-            and_(RoomAccess.user_id == current.id, RoomAccess.room_id == room_id)
-        )
-    )
-    access = result.scalars().first()
-    
-    if access:
-        # Update last_accessed time
-        access.last_accessed = datetime.utcnow()
-    else:
-        # Create new access record
-        access = RoomAccess(user_id=current.id, room_id=room_id)
-        db.add(access)
-    
-    await db.commit()
+    await room_access.record(current.id, room_id)
     return {"status": "ok"}
 
 
@@ -425,18 +491,23 @@ async def get_previous_rooms(db: AsyncSession = Depends(get_db), current: User =
     Returns list of up to 20 most recently accessed rooms, ordered by last access time.
     """
     result = await db.execute(
-        select(RoomAccess)
+        select(RoomAccess.room_id, RoomAccess.last_accessed)
         .where(RoomAccess.user_id == current.id)
         .order_by(RoomAccess.last_accessed.desc())
         .limit(20)
     )
-    rooms = result.scalars().all()
+    # Buffered accesses not yet flushed are newer than what the table holds
+    last_accessed = dict(result.all())
+    for room_id, at in room_access.pending_for(current.id).items():
+        if room_id not in last_accessed or at > last_accessed[room_id]:
+            last_accessed[room_id] = at
+    rooms = sorted(last_accessed.items(), key=lambda item: item[1], reverse=True)[:20]
     return [
         {
-            "room_id": room.room_id,
-            "last_accessed": room.last_accessed,
+            "room_id": room_id,
+            "last_accessed": at,
         }
-        for room in rooms
+        for room_id, at in rooms
     ]
 
 
@@ -451,71 +522,122 @@ async def send_message(payload: schemas.MessageCreate, db: AsyncSession = Depend
     
     - **room_id**: ID of the chat room
     - **body**: Message text (1-2000 characters)
-    - **attachment_url**: Optional URL to attached media
-    - **attachment_type**: Optional type of attachment (image, video, etc.)
+    - **attachment_url**: Optional URL to attached media (up to 2048 characters)
+    - **attachment_type**: Optional type of attachment (image, video, etc.; up to 50 characters)
     """
-    member = await db.execute(select(ChatMember).where(and_(ChatMember.room_id == payload.room_id, ChatMember.user_id == current.id)))
-    if not member.scalars().first():
+    if not await room_members.is_member(db, payload.room_id, current.id):
         raise HTTPException(status_code=403, detail="not in room")
     msg = Message(
+        id=uuid4(),
         sender_id=current.id,
         room_id=payload.room_id,
         body=payload.body,
         attachment_url=payload.attachment_url,
         attachment_type=payload.attachment_type,
+        created_at=datetime.utcnow(),
     )
-    db.add(msg)
-    await db.commit()
-    await db.refresh(msg)
-    await manager.broadcast(payload.room_id, {
+    frame = {
         "type": "message",
         "room_id": payload.room_id,
         "sender_id": str(current.id),
+        "sender_handle": current.handle,
         "body": msg.body,
         "attachment_url": msg.attachment_url,
         "attachment_type": msg.attachment_type,
         "id": str(msg.id),
         "created_at": msg.created_at.isoformat(),
-    })
+    }
+    # Rejected up front rather than saved and then seen on this worker only
+    if not manager.fits(payload.room_id, frame):
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="message too large")
+    db.add(msg)
+    await db.commit()
+    await db.refresh(msg)
+    await manager.broadcast(payload.room_id, frame)
     return msg
 
 
+def encode_cursor(created_at: datetime, row_id) -> str:
+    """Opaque keyset cursor for a message or connection, keyed on (created_at, id)."""
+    raw = f"{created_at.isoformat()},{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split(",", 1)
+        return datetime.fromisoformat(created_at), UUID(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
 @router.get("/messages", response_model=List[schemas.MessageOut], tags=["Chat"])
-async def inbox(room_id: str = Query(...), offset: int = Query(0), limit: int = Query(50), db: AsyncSession = Depends(get_db), current: User = Depends(get_current_user)):
+async def inbox(
+    room_id: str = Query(...),
+    offset: int = Query(0),
+    limit: int = Query(50),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+    current: User = Depends(get_current_user),
+):
     """
     Get message history for a chat room with pagination.
     
     Retrieves messages from a chat room ordered chronologically with pagination support.
     User must be a member of the room to access messages.
+    Every message carries a `cursor`. Pass the first message's cursor as `before`
+    to load older history, or the last one's as `after` to load newer messages.
+    Cursor pages cost the same at any depth; `offset` is kept for older clients.
+    The newest page of an active room is served from memory.
     
     - **room_id**: ID of the chat room (can be string or UUID)
-    - **offset**: Number of messages to skip (for pagination)
+    - **offset**: Number of messages to skip (for pagination, ignored with a cursor)
     - **limit**: Number of messages to return (default 50, max 100)
+    - **before**: Cursor; return the newest messages older than it
+    - **after**: Cursor; return the oldest messages newer than it
     """
     # Clamp limit to max 100
     limit = min(limit, 100)
+    if before and after:
+        raise HTTPException(status_code=400, detail="use either before or after")
     
-    # Convert string room_id to UUID using MD5 hash like WebSocket does
-    try:
-        room_uuid = UUID(room_id)
-    except:
-        # If not a valid UUID, convert string to UUID using MD5 hash
-        room_uuid = UUID(hashlib.md5(room_id.encode()).hexdigest())
+    # Non-UUID room ids map to a UUID the same way the WebSocket does
+    room_uuid = chat_room_uuid(room_id)
     
     # Verify user is a member of the room
-    member = await db.execute(select(ChatMember).where(and_(ChatMember.room_id == room_uuid, ChatMember.user_id == current.id)))
-    if not member.scalars().first():
+    if not await room_members.is_member(db, room_uuid, current.id):
         raise HTTPException(status_code=403, detail="not in room")
     
-    # Get messages with sender info (ordered by descending to get newest first, then reverse)
-    result = await db.execute(
+    # The newest page is usually answered from the room's in-memory buffer
+    if not before and not after and offset == 0:
+        await recent_messages.ensure(room_uuid)
+        recent = recent_messages.recent(room_uuid, limit)
+        if recent is not None:
+            return [
+                schemas.MessageOut(**entry, cursor=encode_cursor(datetime.fromisoformat(entry["created_at"]), entry["id"]))
+                for entry in recent
+            ]
+    
+    # Get messages with sender info
+    query = (
         select(Message, User.handle)
         .join(User, Message.sender_id == User.id)
         .where(Message.room_id == room_uuid)
-        .order_by(Message.created_at.desc())
-        .offset(offset)
-        .limit(limit)
     )
+    key = tuple_(Message.created_at, Message.id)
+    if after:
+        # Oldest first, already chronological
+        query = query.where(key > tuple_(*decode_cursor(after))).order_by(Message.created_at.asc(), Message.id.asc())
+    else:
+        # Newest first, reversed below
+        if before:
+            query = query.where(key < tuple_(*decode_cursor(before)))
+        else:
+            query = query.offset(offset)
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+    result = await db.execute(query.limit(limit))
     rows = result.all()
     
     messages = []
@@ -529,15 +651,18 @@ async def inbox(room_id: str = Query(...), offset: int = Query(0), limit: int =
             'attachment_url': message.attachment_url,
             'attachment_type': message.attachment_type,
             'created_at': message.created_at.isoformat(),
+            'cursor': encode_cursor(message.created_at, message.id),
         }
         messages.append(schemas.MessageOut(**msg_dict))
     
+    if after:
+        return messages
     # Reverse to get chronological order (oldest to newest)
     return list(reversed(messages))
 
 
 @router.get("/store", response_model=List[schemas.StoreItemOut], tags=["Store"])
-async def list_store(db: AsyncSession = Depends(get_db)):
+async def list_store(db: AsyncSession = Depends(get_read_db)):
     """
     List all available store items.
     
@@ -567,6 +692,25 @@ async def seed_store(db: AsyncSession = Depends(get_db)):
     return {"ok": True}
 
 
+@router.get("/paths", response_model=List[schemas.SupplyPathOut], tags=["Map"])
+async def list_paths(db: AsyncSession = Depends(get_read_db), current: User = Depends(get_current_user)):
+    """
+    List your supply paths, most recently touched first.
+
+    health is the number of days a path has left, counted down from its last
+    touch; paths at 0 no longer count for visibility until touched again.
+    """
+    result = await db.execute(
+        select(SupplyPath.friend_id, path_decay.health_expression().label("health"), SupplyPath.last_touch)
+        .where(SupplyPath.user_id == current.id)
+        .order_by(SupplyPath.last_touch.desc())
+    )
+    return [
+        {"friend_id": friend_id, "health": health, "last_touch": last_touch}
+        for friend_id, health, last_touch in result.all()
+    ]
+
+
 @router.post("/paths/touch", tags=["Map"])
 async def touch_path(friend_id: str, q: schemas.VisibilityQuery, db: AsyncSession = Depends(get_db), current: User = Depends(get_current_user)):
     """
@@ -582,8 +726,7 @@ async def touch_path(friend_id: str, q: schemas.VisibilityQuery, db: AsyncSessio
     Both users must have claimed home locations.
     """
     # ensure friendship accepted
-    conn = await db.execute(select(Connection).where(and_(Connection.status == "accepted", or_(and_(Connection.requester_id == current.id, Connection.addressee_id == friend_id), and_(Connection.addressee_id == current.id, Connection.requester_id == friend_id)))))
-    if not conn.scalars().first():
+    if not await friendships.are_friends(db, current.id, friend_id):
         raise HTTPException(status_code=403, detail="not connected")
 
     friend_claim = await db.execute(select(Claim).where(Claim.owner_id == friend_id))
@@ -604,16 +747,18 @@ async def touch_path(friend_id: str, q: schemas.VisibilityQuery, db: AsyncSessio
     existing = path.scalars().first()
     if existing:
         existing.geom = line
-        existing.health = 30
+        existing.health = settings.supply_path_lifetime_days
         existing.last_touch = datetime.utcnow()
     else:
-        db.add(SupplyPath(user_id=current.id, friend_id=friend_id, geom=line, health=30))
+        db.add(SupplyPath(user_id=current.id, friend_id=friend_id, geom=line, health=settings.supply_path_lifetime_days))
+    await db.flush()
+    await visibility_engine.on_paths_changed(db, [current.id])
     await db.commit()
     return {"ok": True}
 
 
 @router.get("/visibility", response_model=schemas.VisibilityOut, tags=["Map"])
-async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession = Depends(get_db), current: User = Depends(get_current_user)):
+async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession = Depends(get_read_db), current: User = Depends(get_current_user)):
     """
     Get visible area based on FOG algorithm.
     
@@ -623,6 +768,9 @@ async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession =
     - Accepted connections' home locations
     - Active supply paths to friends
     
+    Everything except the current location is read from the user's
+    precomputed visible area, which is kept up to date on writes.
+    
     Query parameters:
     - **lat**: Current latitude
     - **lon**: Current longitude
@@ -632,11 +780,7 @@ async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession =
     """
     import json
     
-    # Create a simple circle GeoJSON around the current location for development
-    # In production, this would use the full FOG algorithm
-    radius_km = q.radius_m / 1000.0
-    
-    # Create a simple point feature
+    # Fallback point feature if the geometry cannot be computed
     feature = {
         "type": "Feature",
         "geometry": {
@@ -646,14 +790,15 @@ async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession =
         "properties": {}
     }
     
-    # For visibility, return a simple buffer circle as GeoJSON
     try:
+        source_count = await visibility_engine.ensure(db, current.id)
         pt = func.ST_GeogFromText(f"SRID=4326;POINT({q.lon} {q.lat})")
-        buffer_geom = func.ST_Buffer(pt, q.radius_m)
-        result = await db.execute(select(func.ST_AsGeoJSON(buffer_geom)))
+        here = func.geometry(func.ST_Buffer(pt, q.radius_m))
+        visible = func.ST_Union(func.coalesce(visibility_engine.stored_geom(current.id), here), here)
+        result = await db.execute(select(func.ST_AsGeoJSON(visible)))
         geojson = result.scalar()
         if geojson:
-            return schemas.VisibilityOut(visible_geojson=geojson, source_count=1)
+            return schemas.VisibilityOut(visible_geojson=geojson, source_count=source_count + 1)
     except Exception as e:
         pass
     
@@ -661,8 +806,50 @@ async def visibility(q: schemas.VisibilityQuery = Depends(), db: AsyncSession =
     return schemas.VisibilityOut(visible_geojson=json.dumps(feature["geometry"]), source_count=1)
 
 
+async def _since_position(room_uuid: UUID, since: str) -> Optional[tuple]:
+    """(created_at ISO string, message id) of a since value: a message id or a message cursor."""
+    try:
+        message_id = str(UUID(since))
+    except ValueError:
+        try:
+            created_at, row_id = decode_cursor(since)
+        except HTTPException:
+            return None
+        return created_at.isoformat(), str(row_id)
+    entry = recent_messages.find(room_uuid, message_id)
+    if entry is not None:
+        return entry["created_at"], message_id
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(Message.created_at).where(Message.id == message_id, Message.room_id == room_uuid)
+        )
+        created_at = result.scalar()
+    return (created_at.isoformat(), message_id) if created_at else None
+
+
+async def _join_backlog(room_id: str, room_uuid: UUID, history: int, since: Optional[str]) -> List[dict]:
+    """Frames a joining socket gets before live messages: everything after since, or the last history messages."""
+    await recent_messages.ensure(room_uuid)
+    if since:
+        position = await _since_position(room_uuid, since)
+        entries = None
+        if position is not None:
+            entries = await recent_messages.since(room_uuid, *position, limit=settings.chat_resume_max_messages)
+        if entries is None:
+            return [{"type": "resync"}]
+    else:
+        entries = recent_messages.recent(room_uuid, min(history, recent_messages.room_size)) or []
+    return [{"type": "message", **entry, "room_id": room_id, "replay": True} for entry in entries]
+
+
 @router.websocket("/ws/chat/{room_id}", name="chat_websocket")
-async def chat_ws(websocket: WebSocket, room_id: str, token: str = Query(None), db: AsyncSession = Depends(get_db)):
+async def chat_ws(
+    websocket: WebSocket,
+    room_id: str,
+    token: str = Query(None),
+    history: int = Query(0, ge=0, le=100),
+    since: Optional[str] = Query(None),
+):
     """
     WebSocket endpoint for real-time chat.
     
@@ -671,6 +858,10 @@ async def chat_ws(websocket: WebSocket, room_id: str, token: str = Query(None),
     Connection parameters:
     - **room_id**: Chat room ID (path parameter) - can be a UUID or string
     - **token**: JWT authentication token (query parameter)
+    - **history**: Number of recent messages to replay on connect (default 0, max 100)
+    - **since**: Resume after a message: its id, or a `cursor` from /messages.
+      Every message sent after it is replayed before live messages, each
+      exactly once. Takes precedence over history.
     
     Message format (JSON):
     {
@@ -684,10 +875,25 @@ async def chat_ws(websocket: WebSocket, room_id: str, token: str = Query(None),
         "type": "message",
         "room_id": "...",
         "sender_id": "...",
+        "sender_handle": "...",
         "body": "...",
         "id": "...",
         "created_at": "ISO timestamp"
     }
+    
+    Replayed history arrives first, as the same events with "replay": true.
+    If a since resume cannot be served (unknown message, or more than
+    CHAT_RESUME_MAX_MESSAGES missed) the socket gets {"type": "resync"}
+    instead and should reload history over REST.
+    
+    Messages are broadcast as soon as they arrive and saved in batches. The
+    sender then gets {"type": "ack", "id": "...", "client_id": "...", "persisted": bool}
+    echoing the optional "client_id" of its frame. With CHAT_DURABILITY=sync the
+    ack is only sent once the message is committed ("persisted": true).
+    Frames are checked like POST /messages bodies; invalid ones get
+    {"type": "error", "detail": "invalid message"} and ones too large to reach
+    other workers {"type": "error", "detail": "message too large"}. Neither
+    is broadcast.
     """
     if not token:
         await websocket.close(code=4401)
@@ -698,56 +904,82 @@ async def chat_ws(websocket: WebSocket, room_id: str, token: str = Query(None),
         return
     user_id = payload["sub"]
     
-    # Try to parse as UUID, if not valid create one from string
-    try:
-        room_uuid = UUID(room_id)
-    except ValueError:
-        # Generate UUID from string for non-UUID room IDs (for demo purposes)
-        room_uuid = UUID(hashlib.md5(room_id.encode()).hexdigest())
-    
-    room = await db.execute(select(ChatRoom).where(ChatRoom.id == room_uuid))
-    room = room.scalars().first()
-    
-    if not room:
-        # Auto-create room for development
-        room = ChatRoom(id=room_uuid, name=f"Room: {room_id}", is_group=True)
-        db.add(room)
-        await db.flush()
-    
-    # Ensure user is a member, if not add them (for development)
-    member = await db.execute(select(ChatMember).where(and_(ChatMember.room_id == room_uuid, ChatMember.user_id == user_id)))
-    if not member.scalars().first():
-        # Auto-add user to room for development
-        db.add(ChatMember(room_id=room_uuid, user_id=user_id))
-    
-    await db.commit()
-    await manager.connect(room_id, websocket)
+    # Non-UUID room ids (for demo purposes) map to a UUID derived from the string
+    room_uuid = chat_room_uuid(room_id)
+    
+    # The socket holds no session: joining borrows one briefly, and messages
+    # go through the shared writer. A session only checks out a connection
+    # on its first query, so known members (the common case) use none.
+    async with AsyncSessionLocal() as db:
+        sender = await load_user(db, user_id)
+        if sender is None:
+            await websocket.close(code=4401)
+            return
+        if not await room_members.is_member(db, room_uuid, user_id):
+            room = await db.execute(select(ChatRoom).where(ChatRoom.id == room_uuid))
+            room = room.scalars().first()
+            
+            if not room:
+                # Auto-create room for development
+                room = ChatRoom(id=room_uuid, name=f"Room: {room_id}", is_group=True)
+                db.add(room)
+                await db.flush()
+            
+            # Auto-add user to room for development
+            db.add(ChatMember(room_id=room_uuid, user_id=user_id))
+            await db.commit()
+            room_members.invalidate(room_uuid)
+    # Held until the backlog is known, so nothing broadcast meanwhile is lost or repeated
+    await manager.connect(room_id, websocket, hold=bool(history or since))
     try:
+        if history or since:
+            try:
+                backlog = await _join_backlog(room_id, room_uuid, history, since)
+            except Exception:
+                backlog = [{"type": "resync"}]
+            manager.release(room_id, websocket, backlog)
         while True:
             data = await websocket.receive_json()
-            msg = Message(
+            client_id = data.get("client_id") if isinstance(data, dict) else None
+            # Checked here, as one bad row would fail the writer's whole batch
+            try:
+                incoming = schemas.MessageCreate(**{**data, "room_id": room_id})
+            except (TypeError, ValidationError):
+                manager.send_personal(room_id, websocket, {"type": "error", "client_id": client_id, "detail": "invalid message"})
+                continue
+            msg = message_writer.new_message(
                 sender_id=user_id,
                 room_id=room_uuid,
-                body=data.get("body", ""),
-                attachment_url=data.get("attachment_url"),
-                attachment_type=data.get("attachment_type"),
+                body=incoming.body,
+                attachment_url=incoming.attachment_url,
+                attachment_type=incoming.attachment_type,
             )
-            db.add(msg)
-            await db.commit()
-            await db.refresh(msg)
-            await manager.broadcast(room_id, {
+            frame = {
                 "type": "message",
                 "room_id": room_id,
                 "sender_id": user_id,
-                "body": msg.body,
-                "attachment_url": msg.attachment_url,
-                "attachment_type": msg.attachment_type,
-                "id": str(msg.id),
-                "created_at": msg.created_at.isoformat(),
-            })
+                "sender_handle": sender.handle,
+                "body": msg["body"],
+                "attachment_url": msg["attachment_url"],
+                "attachment_type": msg["attachment_type"],
+                "id": str(msg["id"]),
+                "created_at": msg["created_at"].isoformat(),
+            }
+            if not manager.fits(room_id, frame):
+                manager.send_personal(room_id, websocket, {"type": "error", "client_id": client_id, "detail": "message too large"})
+                continue
+            await manager.broadcast(room_id, frame)
+            durable = settings.chat_durability == DURABILITY_SYNC
+            try:
+                await message_writer.submit(msg, wait=durable)
+            except Exception:
+                manager.send_personal(room_id, websocket, {"type": "error", "id": str(msg["id"]), "client_id": client_id, "detail": "message not saved"})
+                continue
+            manager.send_personal(room_id, websocket, {"type": "ack", "id": str(msg["id"]), "client_id": client_id, "persisted": durable})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(room_id, websocket)
-        return
 
 
 @router.get("/fog", response_model=schemas.FogOut, tags=["Map"])
@@ -757,6 +989,8 @@ async def fog(
     min_lat: float | None = Query(None),
     max_lon: float | None = Query(None),
     max_lat: float | None = Query(None),
+    zoom: float | None = Query(None, ge=0, le=22),
+    format: str = Query("geojson", pattern="^(geojson|twkb|wkb)$"),
     db: AsyncSession = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
@@ -766,34 +1000,62 @@ async def fog(
     Returns GeoJSON polygon of areas NOT visible to the user.
     The inverse of the visibility endpoint.
     
+    The visible area is clipped to the bounding box before the difference is
+    taken, and the result is simplified to about one screen pixel at `zoom`
+    with coordinates rounded to match, so payloads scale with the viewport.
+    
     Query parameters:
     - **lat**: Current latitude
     - **lon**: Current longitude
     - **radius_m**: Detection radius in meters (optional)
-    - **min_lon, min_lat, max_lon, max_lat**: Optional bounding box to limit area
+    - **min_lon, min_lat, max_lon, max_lat**: Optional bounding box to limit area (whole world if omitted)
+    - **zoom**: Optional map zoom used for simplification (derived from the bbox width if omitted)
+    - **format**: `geojson` (default), or `twkb`/`wkb` for a binary geometry body
     
     Returns GeoJSON polygon representing unexplored fog areas within bbox.
     """
     import json
     
-    # For development, return a simple "world minus circle" as an approximation of fog
-    # Create a simple polygon representing unexplored areas
+    bbox = [min_lon, min_lat, max_lon, max_lat]
+    if all(v is not None for v in bbox):
+        if min_lon >= max_lon or min_lat >= max_lat:
+            raise HTTPException(status_code=400, detail="invalid bbox")
+    elif any(v is not None for v in bbox):
+        raise HTTPException(status_code=400, detail="bbox needs min_lon, min_lat, max_lon and max_lat")
+    else:
+        min_lon, min_lat, max_lon, max_lat = -180.0, -90.0, 180.0, 90.0
+    
+    # Simplify to roughly one pixel; assume a 1024px wide viewport without a zoom
+    tolerance = pixel_size_degrees(zoom) if zoom is not None else (max_lon - min_lon) / 1024
+    digits = decimal_digits_for(tolerance)
     
     try:
-        # Try to calculate the actual fog geometry
+        # Visible area is the precomputed one plus the current location
+        source_count = await visibility_engine.ensure(db, current.id)
         pt = func.ST_GeogFromText(f"SRID=4326;POINT({q.lon} {q.lat})")
-        visible_buffer = func.ST_Buffer(pt, q.radius_m)
+        here = func.geometry(func.ST_Buffer(pt, q.radius_m))
+        visible = func.ST_Union(func.coalesce(visibility_engine.stored_geom(current.id), here), here)
         
-        # Create world polygon
-        world = func.ST_GeogFromText("SRID=4326;POLYGON((-180 -90, -180 90, 180 90, 180 -90, -180 -90))")
+        # Clip to the viewport first so the difference only works on what is on screen
+        viewport = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
+        visible = func.ST_ClipByBox2D(visible, viewport)
+        fog_geom = func.ST_SimplifyPreserveTopology(func.ST_Difference(viewport, visible), tolerance)
         
-        # Calculate fog as world minus visible
-        fog_geom = func.ST_Difference(world, visible_buffer)
-        result = await db.execute(select(func.ST_AsGeoJSON(fog_geom)))
-        fog_geojson = result.scalar()
-        
-        if fog_geojson:
-            return schemas.FogOut(fog_geojson=fog_geojson, visible_sources=1)
+        if format == "geojson":
+            result = await db.execute(select(func.ST_AsGeoJSON(fog_geom, digits)))
+            fog_geojson = result.scalar()
+            if fog_geojson:
+                return schemas.FogOut(fog_geojson=fog_geojson, visible_sources=source_count + 1)
+        else:
+            encoded = func.ST_AsTWKB(fog_geom, digits) if format == "twkb" else func.ST_AsBinary(fog_geom)
+            result = await db.execute(select(encoded))
+            body = result.scalar()
+            if body is not None:
+                return Response(
+                    content=bytes(body),
+                    media_type="application/octet-stream",
+                    headers={"X-Visible-Sources": str(source_count + 1)},
+                )
     except Exception as e:
         pass
     
@@ -803,11 +1065,3 @@ async def fog(
         "features": []
     }
     return schemas.FogOut(fog_geojson=json.dumps(empty_fc), visible_sources=0)
-
-    if all(v is not None for v in [min_lon, min_lat, max_lon, max_lat]):
-        bbox = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
-        fog_geom = func.ST_Intersection(fog_geom, bbox)
-
-    result = await db.execute(select(func.ST_AsGeoJSON(fog_geom)))
-    fog_geojson = result.scalar()
-    return schemas.FogOut(fog_geojson=fog_geojson, visible_sources=len(geoms))
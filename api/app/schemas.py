@@ -1,5 +1,6 @@
 from typing import Optional, List
 from datetime import datetime
+from uuid import UUID
 from pydantic import BaseModel, Field, validator
 
 
@@ -96,6 +97,27 @@ class BuildCreate(BaseModel):
     height_m: int = Field(..., ge=1, le=200)
 
 
+class BuildSpec(BaseModel):
+    prefab: str = Field(..., min_length=1, max_length=50)
+    decal: Optional[str] = Field(None, max_length=50)
+    flag: Optional[str] = Field(None, max_length=50)
+    height_m: int = Field(..., ge=1, le=200)
+
+
+class ClaimImportRow(ClaimCreate):
+    """One claim in a bulk import, optionally with its builds."""
+    address_label: str = Field(..., min_length=1, max_length=255)
+    owner_id: Optional[UUID] = None
+    builds: List[BuildSpec] = []
+
+
+class BulkImportReport(BaseModel):
+    received: int
+    inserted: int
+    rejected: int
+    conflicts: List[dict]
+
+
 class BuildOut(BaseModel):
     id: str
     prefab: str
@@ -122,6 +144,8 @@ class ConnectionOut(BaseModel):
     requester_id: str
     addressee_id: str
     status: str
+    cursor: Optional[str] = None
+    mutual_friends: Optional[int] = None
 
     @validator('id', 'requester_id', 'addressee_id', pre=True)
     def convert_uuid_to_str(cls, v):
@@ -136,8 +160,8 @@ class ConnectionOut(BaseModel):
 class MessageCreate(BaseModel):
     room_id: str
     body: str = Field(..., min_length=1, max_length=2000)
-    attachment_url: Optional[str] = None
-    attachment_type: Optional[str] = None
+    attachment_url: Optional[str] = Field(None, max_length=2048)
+    attachment_type: Optional[str] = Field(None, max_length=50)
 
 
 class MessageOut(BaseModel):
@@ -149,6 +173,7 @@ class MessageOut(BaseModel):
     attachment_url: Optional[str]
     attachment_type: Optional[str]
     created_at: str
+    cursor: Optional[str] = None
 
     @validator('id', 'sender_id', 'room_id', pre=True)
     def convert_uuid_to_str(cls, v):
@@ -227,6 +252,18 @@ class VisibilityOut(BaseModel):
     source_count: int
 
 
+class SupplyPathOut(BaseModel):
+    friend_id: str
+    health: int
+    last_touch: datetime
+
+    @validator('friend_id', pre=True)
+    def convert_uuid_to_str(cls, v):
+        if hasattr(v, 'hex'):  # UUID object
+            return str(v)
+        return v
+
+
 class FogOut(BaseModel):
     fog_geojson: str
     visible_sources: int
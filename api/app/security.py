@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
+import asyncio
 import json
+import time
 import httpx
 import bcrypt
 
@@ -25,6 +28,40 @@ def get_password_hash(password: str) -> str:
     hashed = bcrypt.hashpw(password_bytes, salt)
     return hashed.decode('utf-8')
 
+class PasswordWorkOverloaded(Exception):
+    """Raised when too many password hashes/checks are already queued."""
+
+
+# bcrypt releases the GIL, so a small thread pool keeps it off the event loop.
+_password_pool = ThreadPoolExecutor(max_workers=settings.password_workers, thread_name_prefix="bcrypt")
+_password_limit = settings.password_workers + settings.password_queue_depth
+_password_in_flight = 0
+
+
+async def _run_password_work(fn, *args):
+    global _password_in_flight
+    if _password_in_flight >= _password_limit:
+        raise PasswordWorkOverloaded()
+    _password_in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_pool, fn, *args)
+    finally:
+        _password_in_flight -= 1
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password on the bcrypt pool. Raises PasswordWorkOverloaded when saturated."""
+    return await _run_password_work(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """get_password_hash on the bcrypt pool. Raises PasswordWorkOverloaded when saturated."""
+    return await _run_password_work(get_password_hash, password)
+
+
+def password_pool_stats() -> dict:
+    return {"in_flight": _password_in_flight, "limit": _password_limit}
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -37,25 +74,128 @@ def decode_token(token: str) -> Optional[dict]:
     except JWTError:
         return None
 
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+
+class GoogleTokenVerifier:
+    """
+    Verifies Google ID tokens locally (RS256) against Google's published JWKS.
+
+    Keys are cached for the max-age Google sends (or refresh_seconds) and
+    refreshed ahead of expiry by a background task, through one long-lived
+    pooled HTTP client. A token signed with an unknown key id triggers at most
+    one early refresh per minute, which picks up rotated keys. If a refresh
+    fails the previous keys stay in use.
+
+    Point jwks_url at a local key server, pass a client with a mock
+    transport, or call load_jwks() with a fixture to use it in tests.
+    """
+
+    MIN_FORCED_REFRESH_SECONDS = 60
+
+    def __init__(self, jwks_url: str, client_id: Optional[str], refresh_seconds: int = 3600, client: Optional[httpx.AsyncClient] = None):
+        self.jwks_url = jwks_url
+        self.client_id = client_id
+        self.refresh_seconds = refresh_seconds
+        self._client = client
+        self._keys: dict = {}
+        self._expires_at = 0.0
+        self._last_forced = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=2))
+        return self._client
+
+    def load_jwks(self, jwks: dict, ttl_seconds: Optional[float] = None):
+        """Install a key set, e.g. a fixture or a response body from jwks_url."""
+        self._keys = {key["kid"]: key for key in jwks.get("keys", []) if "kid" in key}
+        self._expires_at = time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.refresh_seconds)
+
+    async def refresh_keys(self):
+        async with self._lock:
+            response = await self._http().get(self.jwks_url)
+            response.raise_for_status()
+            self.load_jwks(response.json(), _max_age(response.headers.get("cache-control")) or self.refresh_seconds)
+
+    async def _signing_key(self, kid: str) -> Optional[dict]:
+        now = time.monotonic()
+        stale = now >= self._expires_at
+        unknown = kid not in self._keys and now - self._last_forced >= self.MIN_FORCED_REFRESH_SECONDS
+        if stale or unknown:
+            if unknown:
+                self._last_forced = now
+            try:
+                await self.refresh_keys()
+            except Exception:
+                pass
+        return self._keys.get(kid)
+
+    async def verify(self, id_token: str) -> Optional[dict]:
+        try:
+            header = jwt.get_unverified_header(id_token)
+            key = await self._signing_key(header.get("kid"))
+            if not key:
+                return None
+            claims = jwt.decode(
+                id_token,
+                key,
+                algorithms=["RS256"],
+                audience=self.client_id,
+                options={"verify_aud": bool(self.client_id), "verify_at_hash": False},
+            )
+        except JWTError:
+            return None
+        if claims.get("iss") not in GOOGLE_ISSUERS:
+            return None
+        return {
+            "id": claims.get("sub"),
+            "email": claims.get("email"),
+            "name": claims.get("name"),
+            "picture": claims.get("picture"),
+        }
+
+    async def start(self):
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh_keys()
+            except Exception:
+                pass
+            # Refresh a minute before the keys go stale, retry failures soon
+            await asyncio.sleep(max(self._expires_at - time.monotonic() - 60, 30))
+
+
+def _max_age(cache_control: Optional[str]) -> Optional[int]:
+    for part in (cache_control or "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name == "max-age" and value.isdigit():
+            return int(value)
+    return None
+
+
+google_verifier = GoogleTokenVerifier(
+    settings.google_jwks_url,
+    settings.google_client_id,
+    refresh_seconds=settings.google_jwks_refresh_seconds,
+)
+
+
 async def verify_google_token(id_token: str) -> Optional[dict]:
     """
     Verify Google ID token and return user info.
     Returns dict with id, email, name, picture if valid, None otherwise.
     """
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://oauth2.googleapis.com/tokeninfo",
-                params={"id_token": id_token}
-            )
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    "id": data.get("sub"),
-                    "email": data.get("email"),
-                    "name": data.get("name"),
-                    "picture": data.get("picture"),
-                }
-    except Exception:
-        pass
-    return None
+    return await google_verifier.verify(id_token)
@@ -0,0 +1,112 @@
+"""Mapbox Vector Tile rendering for claims and their builds."""
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+MAX_ZOOM = 22
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+LAYER_NAME = "claims"
+
+# Below this zoom claims are clustered into grid cells instead of drawn one by one.
+CLUSTER_MAX_ZOOM = 13
+# Cluster grid resolution, in cells per tile edge.
+CLUSTER_CELLS = 64
+
+# Web Mercator world width in meters.
+WORLD_SIZE_M = 40075016.68557849
+
+_CLAIMS_SQL = text(
+    """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS env,
+               ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326) AS env_ll
+    ),
+    features AS (
+        SELECT c.id::text AS id,
+               c.owner_id::text AS owner_id,
+               c.address_label,
+               COALESCE(b.prefab, 'cyber') AS prefab,
+               COALESCE(b.flag, 'usa') AS flag,
+               COALESCE(b.height_m, 12) AS height_m,
+               1 AS count,
+               ST_AsMVTGeom(ST_Transform(c.location::geometry, 3857), bounds.env, :extent, :buffer, true) AS geom
+        FROM claims c
+        CROSS JOIN bounds
+        LEFT JOIN LATERAL (
+            SELECT prefab, flag, height_m
+            FROM builds
+            WHERE builds.claim_id = c.id
+            ORDER BY builds.created_at
+            LIMIT 1
+        ) b ON true
+        WHERE c.location::geometry && bounds.env_ll
+    )
+    SELECT ST_AsMVT(features, :layer, :extent, 'geom') FROM features
+    """
+)
+
+_CLUSTERS_SQL = text(
+    """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS env,
+               ST_Transform(ST_TileEnvelope(:z, :x, :y), 4326) AS env_ll
+    ),
+    points AS (
+        SELECT ST_Transform(c.location::geometry, 3857) AS geom,
+               COALESCE(b.height_m, 12) AS height_m
+        FROM claims c
+        CROSS JOIN bounds
+        LEFT JOIN LATERAL (
+            SELECT height_m
+            FROM builds
+            WHERE builds.claim_id = c.id
+            ORDER BY builds.created_at
+            LIMIT 1
+        ) b ON true
+        WHERE c.location::geometry && bounds.env_ll
+    ),
+    clusters AS (
+        SELECT ST_Centroid(ST_Collect(geom)) AS center,
+               count(*) AS count,
+               max(height_m) AS height_m
+        FROM points
+        GROUP BY ST_SnapToGrid(geom, :cell_m)
+    ),
+    features AS (
+        SELECT clusters.count,
+               clusters.height_m,
+               ST_AsMVTGeom(clusters.center, bounds.env, :extent, :buffer, true) AS geom
+        FROM clusters
+        CROSS JOIN bounds
+    )
+    SELECT ST_AsMVT(features, :layer, :extent, 'geom') FROM features
+    """
+)
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    """Check that z/x/y address an existing tile in the XYZ scheme."""
+    if z < 0 or z > MAX_ZOOM:
+        return False
+    n = 1 << z
+    return 0 <= x < n and 0 <= y < n
+
+
+async def render_tile(session: AsyncSession, z: int, x: int, y: int) -> bytes:
+    """
+    Render one MVT tile of claims.
+
+    At zoom levels up to CLUSTER_MAX_ZOOM claims are snapped to a grid of
+    CLUSTER_CELLS per tile edge and emitted as one point per cell with a
+    ``count`` and the tallest ``height_m``. Above it every claim is a feature
+    carrying the prefab/flag/height_m of its first build (with the same
+    defaults as /nearby).
+    """
+    params = {"z": z, "x": x, "y": y, "extent": TILE_EXTENT, "buffer": TILE_BUFFER, "layer": LAYER_NAME}
+    if z <= CLUSTER_MAX_ZOOM:
+        params["cell_m"] = WORLD_SIZE_M / (1 << z) / CLUSTER_CELLS
+        result = await session.execute(_CLUSTERS_SQL, params)
+    else:
+        result = await session.execute(_CLAIMS_SQL, params)
+    tile = result.scalar()
+    return bytes(tile) if tile else b""
@@ -0,0 +1,162 @@
+"""Materialized per-user visibility backed by the visible_areas table."""
+from typing import Iterable, Optional, Sequence
+
+from sqlalchemy import and_, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import AsyncSessionLocal
+from .models import VisibleArea
+
+# A user's visibility is the union of three pieces, each stored as its own
+# visible_areas row, plus a combined "all" row that readers use.
+SOURCE_CLAIMS = "claims"
+SOURCE_FRIENDS = "friends"
+SOURCE_PATHS = "paths"
+SOURCE_ALL = "all"
+SOURCES = (SOURCE_CLAIMS, SOURCE_FRIENDS, SOURCE_PATHS)
+
+_UPSERT = """
+    INSERT INTO visible_areas (id, user_id, source, geom, source_count, refreshed_at)
+    SELECT gen_random_uuid(), u.id, CAST(:source AS varchar), piece.geom, piece.source_count, timezone('utc', now())
+    FROM unnest(CAST(:user_ids AS uuid[])) AS u(id)
+    CROSS JOIN LATERAL ({piece}) AS piece
+    ON CONFLICT (user_id, source) DO UPDATE
+    SET geom = EXCLUDED.geom, source_count = EXCLUDED.source_count, refreshed_at = EXCLUDED.refreshed_at
+"""
+
+_MULTI = "ST_Multi(ST_CollectionExtract(ST_Union({geom}), 3))::geography"
+
+_PIECES = {
+    SOURCE_CLAIMS: f"""
+        SELECT {_MULTI.format(geom="ST_Buffer(c.location, CAST(:home_radius_m AS float8))::geometry")} AS geom,
+               count(*) AS source_count
+        FROM claims c
+        WHERE c.owner_id = u.id
+    """,
+    SOURCE_FRIENDS: f"""
+        SELECT {_MULTI.format(geom="ST_Buffer(c.location, CAST(:home_radius_m AS float8))::geometry")} AS geom,
+               count(*) AS source_count
+        FROM friend_edges f
+        JOIN claims c ON c.owner_id = f.friend_id
+        WHERE f.user_id = u.id
+    """,
+    SOURCE_PATHS: f"""
+        SELECT {_MULTI.format(geom="ST_Buffer(p.geom, CAST(:path_radius_m AS float8))::geometry")} AS geom,
+               count(*) AS source_count
+        FROM supply_paths p
+        WHERE p.user_id = u.id
+          AND p.last_touch > timezone('utc', now()) - make_interval(days => CAST(:path_lifetime_days AS int))
+    """,
+    SOURCE_ALL: f"""
+        SELECT {_MULTI.format(geom="v.geom::geometry")} AS geom,
+               COALESCE(sum(v.source_count), 0) AS source_count
+        FROM visible_areas v
+        WHERE v.user_id = u.id AND v.source <> 'all'
+    """,
+}
+
+_UNMATERIALIZED = text(
+    """
+    SELECT u.id
+    FROM unnest(CAST(:user_ids AS uuid[])) AS u(id)
+    WHERE NOT EXISTS (SELECT 1 FROM visible_areas v WHERE v.user_id = u.id AND v.source = 'all')
+    """
+)
+
+_FRIENDS_OF = text("SELECT friend_id FROM friend_edges WHERE user_id = :user_id")
+
+
+class VisibilityEngine:
+    """
+    Keeps visible_areas in sync with the sources that make up visibility.
+
+    Each write only re-unions the piece it touched (a user's own claims, their
+    friends' homes or their live supply paths) and then folds the three
+    stored pieces into the combined row, so reads never touch the source tables.
+    A supply path counts while it was touched within its lifetime; PathDecay
+    refreshes the paths piece of users whose paths have since expired.
+    """
+
+    def __init__(self, home_radius_m: int, path_radius_m: int, path_lifetime_days: int):
+        self.home_radius_m = home_radius_m
+        self.path_radius_m = path_radius_m
+        self.path_lifetime_days = path_lifetime_days
+
+    async def refresh(self, db: AsyncSession, user_ids: Iterable, sources: Sequence[str] = SOURCES):
+        """Recompute the given pieces for users and their combined rows (commit is the caller's)."""
+        ids = list({str(uid) for uid in user_ids})
+        if not ids:
+            return
+        params = {
+            "home_radius_m": self.home_radius_m,
+            "path_radius_m": self.path_radius_m,
+            "path_lifetime_days": self.path_lifetime_days,
+        }
+        # Users never materialized need every piece, not only the changed one.
+        result = await db.execute(_UNMATERIALIZED, {"user_ids": ids})
+        fresh = [str(row[0]) for row in result.all()]
+        for source in SOURCES:
+            targets = ids if source in sources else fresh
+            if targets:
+                await db.execute(
+                    text(_UPSERT.format(piece=_PIECES[source])),
+                    {**params, "user_ids": targets, "source": source},
+                )
+        await db.execute(
+            text(_UPSERT.format(piece=_PIECES[SOURCE_ALL])),
+            {**params, "user_ids": ids, "source": SOURCE_ALL},
+        )
+
+    async def on_claims_changed(self, db: AsyncSession, owner_id):
+        """A user's homes changed: their own piece and their friends' pieces move."""
+        result = await db.execute(_FRIENDS_OF, {"user_id": owner_id})
+        friend_ids = [row[0] for row in result.all()]
+        await self.refresh(db, [owner_id], [SOURCE_CLAIMS])
+        await self.refresh(db, friend_ids, [SOURCE_FRIENDS])
+
+    async def on_connection_changed(self, db: AsyncSession, user_a, user_b):
+        await self.refresh(db, [user_a, user_b], [SOURCE_FRIENDS])
+
+    async def on_paths_changed(self, db: AsyncSession, user_ids: Iterable):
+        await self.refresh(db, user_ids, [SOURCE_PATHS])
+
+    async def ensure(self, db: AsyncSession, user_id) -> int:
+        """
+        Make sure the user's combined row exists and return its source count.
+
+        Users with no rows yet (e.g. created before the engine) are
+        materialized on first read. That write always goes to the primary, so
+        db may be a read-replica session.
+        """
+        count = await self._source_count(db, user_id)
+        if count is None:
+            async with AsyncSessionLocal() as primary:
+                await self.refresh(primary, [user_id])
+                await primary.commit()
+                count = await self._source_count(primary, user_id)
+        return count or 0
+
+    @staticmethod
+    def stored_geom(user_id):
+        """Scalar subquery for the user's combined visible area as geometry (NULL if empty)."""
+        return (
+            select(func.geometry(VisibleArea.geom))
+            .where(and_(VisibleArea.user_id == user_id, VisibleArea.source == SOURCE_ALL))
+            .scalar_subquery()
+        )
+
+    async def _source_count(self, db: AsyncSession, user_id) -> Optional[int]:
+        result = await db.execute(
+            select(VisibleArea.source_count).where(
+                and_(VisibleArea.user_id == user_id, VisibleArea.source == SOURCE_ALL)
+            )
+        )
+        return result.scalar()
+
+
+visibility_engine = VisibilityEngine(
+    settings.visibility_home_radius_m,
+    settings.visibility_path_radius_m,
+    settings.supply_path_lifetime_days,
+)
@@ -0,0 +1,182 @@
+"""
+Soak the chat WebSocket with thousands of concurrent sockets.
+
+Creates throwaway users in the database the API uses, opens --sockets chat
+sockets spread over --rooms rooms against a running API, and has each one
+send a message every --interval seconds on average for --duration seconds.
+Meanwhile GET /stats is polled to track how many pooled DB connections are
+checked out. Idle sockets should hold none: the run passes when every socket
+connected and the pool never ran out.
+
+    cd api && pip install -e '.[bench]'
+    cd api && uvicorn app.main:app --port 8000 &
+    cd api && python -m bench.chat_ws_soak --sockets 2000 --duration 60
+
+Needs the same DATABASE_URL and JWT_SECRET as the API, a local Postgres, and
+a file descriptor limit above the socket count (ulimit -n). Soak users and
+their rooms are deleted afterwards unless --keep is given.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+
+import httpx
+import websockets
+from sqlalchemy import delete, insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal, engine
+from app.models import ChatRoom, User
+from app.security import create_access_token
+
+
+class Totals:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.dropped = 0
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        self.received = 0
+        self.ack_ms: list = []
+        self.pool_checked_out_max = 0
+        self.pool_wait_max_ms = 0.0
+
+
+async def _create_rooms(room_ids: list):
+    # Created up front so the first sockets do not race to auto-create them
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            insert(ChatRoom), [{"id": room_id, "name": "soak", "is_group": True} for room_id in room_ids]
+        )
+        await session.commit()
+
+
+async def _create_users(count: int) -> list:
+    users = [
+        {
+            "id": uuid.uuid4(),
+            "handle": f"soak{uuid.uuid4().hex[:24]}",
+            "email": f"soak-{uuid.uuid4().hex}@example.invalid",
+            "password_hash": "!",
+        }
+        for _ in range(count)
+    ]
+    async with AsyncSessionLocal() as session:
+        await session.execute(insert(User), users)
+        await session.commit()
+    return [user["id"] for user in users]
+
+
+async def _cleanup(user_ids: list, room_ids: list):
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(User).where(User.id.in_(user_ids)))
+        await session.execute(delete(ChatRoom).where(ChatRoom.id.in_(room_ids)))
+        await session.commit()
+
+
+async def _socket(url: str, totals: Totals, interval: float, stop_at: float, connect_gate: asyncio.Semaphore):
+    pending = {}
+    try:
+        async with connect_gate:
+            ws = await websockets.connect(url, open_timeout=30, max_queue=None)
+    except Exception:
+        totals.failed += 1
+        return
+    totals.connected += 1
+
+    async def reader():
+        async for raw in ws:
+            frame = json.loads(raw)
+            kind = frame.get("type")
+            if kind == "ack":
+                started = pending.pop(frame.get("client_id"), None)
+                if started is not None:
+                    totals.acked += 1
+                    totals.ack_ms.append((time.perf_counter() - started) * 1000)
+            elif kind == "error":
+                totals.errors += 1
+            elif kind == "message":
+                totals.received += 1
+
+    reading = asyncio.create_task(reader())
+    try:
+        while time.monotonic() < stop_at:
+            await asyncio.sleep(random.expovariate(1 / interval))
+            client_id = uuid.uuid4().hex
+            pending[client_id] = time.perf_counter()
+            await ws.send(json.dumps({"body": "soak", "client_id": client_id}))
+            totals.sent += 1
+        await asyncio.sleep(2)
+    except websockets.ConnectionClosed:
+        totals.dropped += 1
+    finally:
+        reading.cancel()
+        await ws.close()
+
+
+async def _watch_pool(base_url: str, totals: Totals, stop_at: float):
+    async with httpx.AsyncClient(base_url=base_url, timeout=5) as client:
+        while time.monotonic() < stop_at:
+            try:
+                pool = (await client.get("/stats")).json()["db_pool"]["primary"]
+                totals.pool_checked_out_max = max(totals.pool_checked_out_max, pool["checked_out"])
+                totals.pool_wait_max_ms = max(totals.pool_wait_max_ms, pool["checkout_wait_max_ms"])
+            except Exception:
+                pass
+            await asyncio.sleep(1)
+
+
+async def main(args):
+    totals = Totals()
+    ws_base = args.base_url.replace("http", "ws", 1)
+    room_ids = [uuid.uuid4() for _ in range(args.rooms)]
+    await _create_rooms(room_ids)
+    user_ids = await _create_users(args.sockets)
+    pool_limit = settings.db_pool_size + settings.db_max_overflow
+    try:
+        stop_at = time.monotonic() + args.duration
+        gate = asyncio.Semaphore(args.connect_concurrency)
+        urls = [
+            f"{ws_base}/ws/chat/{room_ids[i % args.rooms]}?token={create_access_token({'sub': str(user_id)})}"
+            for i, user_id in enumerate(user_ids)
+        ]
+        watcher = asyncio.create_task(_watch_pool(args.base_url, totals, stop_at + 5))
+        await asyncio.gather(*(_socket(url, totals, args.interval, stop_at, gate) for url in urls))
+        await watcher
+    finally:
+        if not args.keep:
+            await _cleanup(user_ids, room_ids)
+        await engine.dispose()
+
+    ack_ms = sorted(totals.ack_ms) or [0.0]
+    print(f"sockets: {totals.connected} connected, {totals.failed} failed, {totals.dropped} dropped early")
+    print(f"messages: {totals.sent} sent, {totals.acked} acked, {totals.errors} errors, {totals.received} broadcast frames")
+    print(
+        f"ack latency: p50={statistics.median(ack_ms):.1f}ms "
+        f"p99={ack_ms[max(0, int(len(ack_ms) * 0.99) - 1)]:.1f}ms max={ack_ms[-1]:.1f}ms"
+    )
+    print(
+        f"db pool: max checked out {totals.pool_checked_out_max} of {pool_limit}, "
+        f"max checkout wait {totals.pool_wait_max_ms:.1f}ms"
+    )
+    ok = totals.failed == 0 and totals.pool_checked_out_max < pool_limit
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--sockets", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--interval", type=float, default=10.0, help="mean seconds between messages per socket")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="keep soak users and rooms")
+    raise SystemExit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,131 @@
+"""
+Compare the old and new ways of reading claim coordinates on large results.
+
+Loads random points into a temporary copy of the claims columns and times
+building /my-claims style dicts from each query:
+
+- astext: the full row plus ST_X/ST_Y(ST_AsText(location)), so every row
+  carries its geography as WKB and its coordinates through WKT text
+- stored: the stored lat/lon columns only
+
+Needs a PostGIS database at DATABASE_URL; nothing outside the temporary
+table is touched.
+
+    cd api && python -m bench.claim_coordinates --rows 10000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import uuid
+
+from geoalchemy2 import Geography
+from sqlalchemy import Column, Computed, Float, MetaData, String, Table, func, insert, select, text
+from sqlalchemy.dialects.postgresql import UUID
+
+from app.database import engine
+
+metadata = MetaData()
+bench_claims = Table(
+    "bench_claims",
+    metadata,
+    Column("id", UUID(as_uuid=True), primary_key=True),
+    Column("owner_id", UUID(as_uuid=True)),
+    Column("address_label", String(255)),
+    Column("location", Geography(geometry_type="POINT", srid=4326, spatial_index=False)),
+    Column("lat", Float, Computed("ST_Y(location::geometry)", persisted=True)),
+    Column("lon", Float, Computed("ST_X(location::geometry)", persisted=True)),
+    prefixes=["TEMPORARY"],
+)
+
+
+def _astext_rows(rows) -> list:
+    claims = []
+    for row in rows:
+        lon, lat = row[-2], row[-1]
+        claims.append({
+            "id": str(row.id),
+            "owner_id": str(row.owner_id),
+            "address_label": row.address_label,
+            "lat": float(lat),
+            "lon": float(lon),
+        })
+    return claims
+
+
+def _stored_rows(rows) -> list:
+    return [
+        {
+            "id": str(row.id),
+            "owner_id": str(row.owner_id),
+            "address_label": row.address_label,
+            "lat": row.lat,
+            "lon": row.lon,
+        }
+        for row in rows
+    ]
+
+
+QUERIES = {
+    "astext": (
+        select(
+            bench_claims,
+            func.ST_X(func.ST_AsText(bench_claims.c.location)),
+            func.ST_Y(func.ST_AsText(bench_claims.c.location)),
+        ),
+        _astext_rows,
+    ),
+    "stored": (
+        select(
+            bench_claims.c.id,
+            bench_claims.c.owner_id,
+            bench_claims.c.address_label,
+            bench_claims.c.lat,
+            bench_claims.c.lon,
+        ),
+        _stored_rows,
+    ),
+}
+
+
+async def main(rows: int, repeat: int):
+    owner = uuid.uuid4()
+    async with engine.connect() as conn:
+        await conn.run_sync(metadata.create_all)
+        points = [
+            {
+                "id": uuid.uuid4(),
+                "owner_id": owner,
+                "address_label": f"bench {i}",
+                "location": f"SRID=4326;POINT({random.uniform(-124, -67)} {random.uniform(25, 49)})",
+            }
+            for i in range(rows)
+        ]
+        await conn.execute(insert(bench_claims), points)
+        await conn.execute(text("ANALYZE bench_claims"))
+
+        for name, (query, build) in QUERIES.items():
+            query_ms, build_ms = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = (await conn.execute(query)).all()
+                fetched = time.perf_counter()
+                build(result)
+                query_ms.append((fetched - start) * 1000)
+                build_ms.append((time.perf_counter() - fetched) * 1000)
+            print(
+                f"{name:>6}: {rows} rows | query+decode p50={statistics.median(query_ms):.1f}ms "
+                f"| dicts p50={statistics.median(build_ms):.1f}ms "
+                f"| total p50={statistics.median([q + b for q, b in zip(query_ms, build_ms)]):.1f}ms"
+            )
+        await conn.rollback()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
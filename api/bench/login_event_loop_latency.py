@@ -0,0 +1,76 @@
+"""
+Measure event-loop latency while many logins verify passwords at once.
+
+Runs the same burst of bcrypt checks twice: inline on the event loop (the
+old verify_password path) and through the bcrypt worker pool
+(verify_password_async). A ticker task records how late each 5 ms tick
+fires, which is the delay every other request on the worker would see.
+
+    cd api && python -m bench.login_event_loop_latency --logins 32
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.security import (
+    PasswordWorkOverloaded,
+    get_password_hash,
+    verify_password,
+    verify_password_async,
+)
+
+TICK_SECONDS = 0.005
+
+
+async def _ticker(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK_SECONDS)
+        lags.append((time.perf_counter() - start - TICK_SECONDS) * 1000)
+
+
+async def _inline_login(password: str, hashed: str):
+    verify_password(password, hashed)
+
+
+async def _pooled_login(password: str, hashed: str):
+    try:
+        await verify_password_async(password, hashed)
+    except PasswordWorkOverloaded:
+        return "rejected"
+
+
+async def _run(mode: str, logins: int, password: str, hashed: str):
+    lags: list = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    await asyncio.sleep(TICK_SECONDS * 4)
+    login = _inline_login if mode == "inline" else _pooled_login
+    started = time.perf_counter()
+    results = await asyncio.gather(*(login(password, hashed) for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    lags.sort()
+    rejected = sum(1 for r in results if r == "rejected")
+    print(
+        f"{mode:>6}: {logins} logins in {elapsed:.2f}s ({rejected} rejected) | "
+        f"loop lag p50={statistics.median(lags):.1f}ms "
+        f"p99={lags[int(len(lags) * 0.99) - 1]:.1f}ms max={lags[-1]:.1f}ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=16, help="concurrent logins per run")
+    args = parser.parse_args()
+
+    password = "correct horse battery staple"
+    hashed = get_password_hash(password)
+    for mode in ("inline", "pool"):
+        await _run(mode, args.logins, password, hashed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
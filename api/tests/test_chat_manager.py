@@ -0,0 +1,119 @@
+"""
+Holding a joining socket and releasing it with a backlog.
+
+Runs the ChatManager on the in-memory backplane with fake sockets, so no
+database or server is needed.
+
+    cd api && python -m pytest tests/test_chat_manager.py
+"""
+import asyncio
+import json
+
+from app.backplane import MemoryBackplane
+from app.chat_manager import OVERFLOW_DISCONNECT, SLOW_CONSUMER_CLOSE_CODE, ChatManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        self.sent.append(json.loads(text))
+
+    async def close(self, code: int = 1000):
+        self.closed = code
+
+
+def _message(n: int) -> dict:
+    return {"type": "message", "id": f"m{n}", "body": str(n)}
+
+
+async def _drain():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def _manager(**kwargs) -> ChatManager:
+    manager = ChatManager(MemoryBackplane(), **kwargs)
+    await manager.start()
+    return manager
+
+
+async def test_release_sends_backlog_then_held_without_repeats():
+    manager = await _manager()
+    socket = FakeWebSocket()
+    await manager.connect("room", socket, hold=True)
+    await manager.broadcast("room", _message(2))
+    await manager.broadcast("room", _message(3))
+    await _drain()
+    assert socket.sent == []
+
+    manager.release("room", socket, [_message(1), _message(2)])
+    await manager.broadcast("room", _message(4))
+    await _drain()
+
+    assert [frame["id"] for frame in socket.sent] == ["m1", "m2", "m3", "m4"]
+    await manager.stop()
+
+
+async def test_held_overflow_sends_resync_only():
+    manager = await _manager(max_queue=3)
+    socket = FakeWebSocket()
+    await manager.connect("room", socket, hold=True)
+    for n in range(5):
+        await manager.broadcast("room", _message(n))
+
+    manager.release("room", socket, [_message(-1)])
+    await manager.broadcast("room", _message(5))
+    await _drain()
+
+    assert socket.sent == [{"type": "resync"}, _message(5)]
+    assert manager.dropped_messages == 5
+    await manager.stop()
+
+
+async def test_held_overflow_disconnects_under_disconnect_policy():
+    manager = await _manager(max_queue=2, overflow_policy=OVERFLOW_DISCONNECT)
+    socket = FakeWebSocket()
+    await manager.connect("room", socket, hold=True)
+    for n in range(3):
+        await manager.broadcast("room", _message(n))
+    await _drain()
+
+    assert "room" not in manager.rooms
+    assert socket.closed == SLOW_CONSUMER_CLOSE_CODE
+    await manager.stop()
+
+
+class RecordingBackplane(MemoryBackplane):
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.published = []
+
+    def fits(self, event: dict) -> bool:
+        return len(json.dumps(event)) <= self.max_bytes
+
+    async def publish(self, event: dict):
+        self.published.append(event)
+        await super().publish(event)
+
+
+async def test_presence_reports_busiest_rooms_that_fit():
+    backplane = RecordingBackplane(max_bytes=200)
+    manager = ChatManager(backplane, presence_interval=60)
+    for n in range(20):
+        for _ in range(n):
+            await manager.connect(f"room-{n:02d}", FakeWebSocket())
+    await manager.start()
+    await _drain()
+
+    presence = next(event for event in backplane.published if event["type"] == "presence")
+    assert backplane.fits(presence)
+    assert list(presence["rooms"]) == [f"room-{n:02d}" for n in range(19, 19 - len(presence["rooms"]), -1)]
+    assert not manager.fits("room-19", {"type": "message", "body": "x" * 200})
+    await manager.stop()
@@ -0,0 +1,138 @@
+"""
+Local verification of Google ID tokens against a fixture JWKS.
+
+Signs tokens with freshly generated RSA keys and serves the key set through
+an httpx mock transport standing in for Google's key server.
+
+    cd api && python -m pytest tests/test_google_verifier.py
+"""
+import time
+
+import httpx
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+from app.security import GoogleTokenVerifier
+
+CLIENT_ID = "test-client.apps.googleusercontent.com"
+JWKS_URL = "https://keys.test/certs"
+
+
+class SigningKey:
+    def __init__(self, kid: str):
+        self.kid = kid
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        public_pem = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        self.jwk = {**jwk.construct(public_pem, "RS256").to_dict(), "kid": kid, "use": "sig"}
+
+    def token(self, **overrides) -> str:
+        now = int(time.time())
+        claims = {
+            "iss": "https://accounts.google.com",
+            "aud": CLIENT_ID,
+            "sub": "google-user-1",
+            "email": "player@example.com",
+            "name": "Player One",
+            "iat": now,
+            "exp": now + 600,
+            **overrides,
+        }
+        return jwt.encode(claims, self.pem, algorithm="RS256", headers={"kid": self.kid})
+
+
+class KeyServer:
+    """Serves whatever key set it currently holds, or fails while down."""
+
+    def __init__(self, *keys: SigningKey):
+        self.keys = list(keys)
+        self.down = False
+        self.requests = 0
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.down:
+            return httpx.Response(503)
+        return httpx.Response(
+            200,
+            json={"keys": [key.jwk for key in self.keys]},
+            headers={"cache-control": "public, max-age=3600"},
+        )
+
+
+@pytest.fixture(scope="module")
+def first_key() -> SigningKey:
+    return SigningKey("key-1")
+
+
+@pytest.fixture(scope="module")
+def second_key() -> SigningKey:
+    return SigningKey("key-2")
+
+
+def _verifier(server: KeyServer) -> GoogleTokenVerifier:
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server.handle))
+    return GoogleTokenVerifier(JWKS_URL, CLIENT_ID, client=client)
+
+
+async def test_valid_token(first_key):
+    server = KeyServer(first_key)
+    verifier = _verifier(server)
+    verifier.load_jwks({"keys": [first_key.jwk]})
+
+    user = await verifier.verify(first_key.token())
+
+    assert user == {"id": "google-user-1", "email": "player@example.com", "name": "Player One", "picture": None}
+    assert server.requests == 0
+    await verifier.stop()
+
+
+async def test_wrong_audience(first_key):
+    verifier = _verifier(KeyServer(first_key))
+    verifier.load_jwks({"keys": [first_key.jwk]})
+
+    assert await verifier.verify(first_key.token(aud="someone-else")) is None
+    await verifier.stop()
+
+
+async def test_wrong_issuer(first_key):
+    verifier = _verifier(KeyServer(first_key))
+    verifier.load_jwks({"keys": [first_key.jwk]})
+
+    assert await verifier.verify(first_key.token(iss="https://evil.example.com")) is None
+    await verifier.stop()
+
+
+async def test_unknown_kid_forces_at_most_one_refresh_a_minute(first_key, second_key):
+    server = KeyServer(first_key)
+    verifier = _verifier(server)
+    verifier.load_jwks({"keys": [first_key.jwk]})
+    token = second_key.token()
+
+    assert await verifier.verify(token) is None
+    assert await verifier.verify(token) is None
+    assert server.requests == 1
+
+    # Google rotates its keys; the next forced refresh is allowed a minute later
+    server.keys = [first_key, second_key]
+    verifier._last_forced -= GoogleTokenVerifier.MIN_FORCED_REFRESH_SECONDS
+    assert (await verifier.verify(token))["id"] == "google-user-1"
+    assert server.requests == 2
+    await verifier.stop()
+
+
+async def test_failed_refresh_keeps_previous_keys(first_key):
+    server = KeyServer(first_key)
+    server.down = True
+    verifier = _verifier(server)
+    verifier.load_jwks({"keys": [first_key.jwk]}, ttl_seconds=0)
+
+    user = await verifier.verify(first_key.token())
+
+    assert server.requests == 1
+    assert user["id"] == "google-user-1"
+    await verifier.stop()
@@ -0,0 +1,57 @@
+"""
+Batched chat message writes when some rows cannot be written.
+
+Replaces the INSERT with an in-memory stand-in, so no database is needed.
+
+    cd api && python -m pytest tests/test_message_writer.py
+"""
+import asyncio
+from typing import List
+
+import pytest
+
+from app.message_writer import MessageWriter
+
+
+class RejectingWriter(MessageWriter):
+    """Writes rows to a list and fails any INSERT that contains a body of "bad"."""
+
+    def __init__(self, **kwargs):
+        super().__init__(session_factory=None, **kwargs)
+        self.written: List[str] = []
+
+    async def _insert(self, rows: List[dict]):
+        if any(row["body"] == "bad" for row in rows):
+            raise ValueError("rejected")
+        self.written.extend(row["body"] for row in rows)
+
+    def hold(self):
+        # Queue rows instead of writing through, as if the flush task were running
+        self._task = object()
+
+
+async def test_bad_row_only_loses_itself():
+    writer = RejectingWriter()
+    writer.hold()
+    for body in ("a", "bad", "c"):
+        await writer.submit(writer.new_message("user", "room", body))
+
+    await writer.flush()
+
+    assert writer.written == ["a", "c"]
+    assert writer.stats()["flushed_rows"] == 2
+    assert writer.stats()["failed_rows"] == 1
+
+
+async def test_waiting_callers_see_their_own_outcome():
+    writer = RejectingWriter()
+    writer.hold()
+    good = asyncio.create_task(writer.submit(writer.new_message("user", "room", "ok"), wait=True))
+    bad = asyncio.create_task(writer.submit(writer.new_message("user", "room", "bad"), wait=True))
+    await asyncio.sleep(0)
+
+    await writer.flush()
+
+    await good
+    with pytest.raises(ValueError):
+        await bad
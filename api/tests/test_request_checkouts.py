@@ -0,0 +1,109 @@
+"""
+Each API request checks out at most one pooled DB connection.
+
+Drives the claim and build endpoints in-process through the ASGI app with a
+throwaway user and reads the pool's checkout counter around every request.
+Auth and map caches are cleared before each request so the user lookup in
+get_current_user always hits the database; it must share the handler's
+session rather than take a second connection.
+
+Needs a migrated PostGIS database at DATABASE_URL (start the API against it
+once) and no DATABASE_READ_URL; skipped otherwise. The user and its claims
+are deleted afterwards.
+
+    cd api && python -m pytest tests/test_request_checkouts.py
+"""
+import random
+import re
+import uuid
+
+import httpx
+import pytest
+from sqlalchemy import delete, insert, text
+
+from app.cache import map_cache
+from app.database import AsyncSessionLocal, engine, read_engine
+from app.deps import token_cache, user_cache
+from app.main import app
+from app.models import User
+from app.security import create_access_token
+
+pytestmark = pytest.mark.skipif(read_engine is not engine, reason="DATABASE_READ_URL is set; reads must share the primary pool")
+
+_ID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+ROUNDS = 3
+
+
+async def _database_available() -> bool:
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1 FROM claims LIMIT 1"))
+        return True
+    except Exception:
+        return False
+
+
+async def _clear_caches():
+    token_cache.clear()
+    user_cache.clear()
+    await map_cache.invalidate_all()
+
+
+async def _create_user() -> uuid.UUID:
+    user_id = uuid.uuid4()
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            insert(User),
+            [{
+                "id": user_id,
+                "handle": f"test{uuid.uuid4().hex[:24]}",
+                "email": f"test-{uuid.uuid4().hex}@example.invalid",
+                "password_hash": "!",
+            }],
+        )
+        await session.commit()
+    return user_id
+
+
+async def _measure(client: httpx.AsyncClient, results: list, method: str, url: str, **kwargs) -> httpx.Response:
+    await _clear_caches()
+    before = engine.pool.checkouts
+    response = await client.request(method, url, **kwargs)
+    results.append((f"{method} {_ID.sub('{id}', url.split('?')[0])}", response.status_code, engine.pool.checkouts - before))
+    return response
+
+
+async def test_one_checkout_per_request():
+    if not await _database_available():
+        pytest.skip("no migrated database at DATABASE_URL")
+    user_id = await _create_user()
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", headers=headers) as client:
+            for _ in range(ROUNDS):
+                lat, lon = random.uniform(25, 49), random.uniform(-124, -67)
+                created = await _measure(
+                    client, results, "POST", "/claims",
+                    json={"lat": lat, "lon": lon, "address_label": "test"},
+                )
+                assert created.status_code == 200, created.text
+                await _measure(client, results, "GET", "/my-claims")
+                await _measure(client, results, "GET", f"/nearby?lat={lat}&lon={lon}&radius_m=500")
+                claim_id = created.json()["id"]
+                await _measure(client, results, "PATCH", f"/claims/{claim_id}", json={"address_label": "test 2"})
+                build = {"claim_id": claim_id, "prefab": "hut", "height_m": 3}
+                built = await _measure(client, results, "POST", "/builds", json=build)
+                assert built.status_code == 200, built.text
+                await _measure(client, results, "PUT", f"/builds/{built.json()['id']}", json={**build, "height_m": 4})
+                await _measure(client, results, "DELETE", f"/claims/{claim_id}")
+    finally:
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(User).where(User.id == user_id))
+            await session.commit()
+        await engine.dispose()
+
+    assert all(status_code < 400 for _, status_code, _ in results), results
+    over = [(endpoint, checkouts) for endpoint, _, checkouts in results if checkouts > 1]
+    assert not over, f"requests with more than one checkout: {over}"